@@ -1,7 +1,6 @@
 # /// script
 # dependencies = [
 #     "numpy",
-#     "scipy",
 # ]
 # ///
 
@@ -9,58 +8,212 @@
 Convert a cashflow CSV file into a resampled WAV.
 """
 
+import argparse
 import csv
-import datetime
-from collections import defaultdict
+import hashlib
+import itertools
+import os
+import wave
+from pathlib import Path
 
 import numpy as np
-import scipy.io.wavfile
 
+# Rows parsed per chunk when reading the CSV
+CHUNK_ROWS = 1_000_000
+# Samples resampled and written per chunk when writing the WAV
+CHUNK_SAMPLES = 1 << 20
 
-def read_events():
-    aps = defaultdict(list)
 
-    with open("cashflow.csv") as f:
-        t0 = None
-        for i, row in enumerate(csv.DictReader(f)):
-            t = datetime.datetime.strptime(row["date"][:19], "%Y-%m-%d %H:%M:%S")
-            if not t0:
-                t0 = t
-            a = float(row["cashflow"])
-            aps[(t - t0).total_seconds()].append(a)
+def read_columns(path, *, chunk_rows=CHUNK_ROWS):
+    """
+    Read the `date` and `cashflow` columns in chunks,
+    yielding `(datetime64[s] array, float64 array)` pairs.
+    """
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        date_index = header.index("date")
+        cashflow_index = header.index("cashflow")
+        while rows := list(itertools.islice(reader, chunk_rows)):
+            # numpy parses "YYYY-MM-DD HH:MM:SS" (and the amounts) in bulk
+            dates = np.array(
+                [row[date_index][:19] for row in rows],
+                dtype="datetime64[s]",
+            )
+            amounts = np.array([row[cashflow_index] for row in rows], dtype=np.float64)
+            yield dates, amounts
 
-    return aps
 
+def group_events(seconds: np.ndarray, amounts: np.ndarray):
+    """
+    Group amounts by equal timestamps.
 
-def expand_groups(aps):
-    aps = sorted(aps.items())
-    for ps_idx, (t, ps) in enumerate(aps):
-        next_t = aps[ps_idx + 1][0] if ps_idx + 1 < len(aps) else t + 60
-        delta_t = next_t - t
-        for i, v in enumerate(ps):
-            yield (t + i / len(ps) * delta_t, v)
+    Returns the sorted unique times, the number of events at each time,
+    and the amounts ordered by time (keeping the file order within a group).
+    """
+    order = np.argsort(seconds, kind="stable")
+    times, counts = np.unique(seconds[order], return_counts=True)
+    return times, counts, amounts[order]
+
+
+def read_events(path="cashflow.csv"):
+    chunks = list(read_columns(path))
+    dates = np.concatenate([dates for dates, _ in chunks])
+    amounts = np.concatenate([amounts for _, amounts in chunks])
+    del chunks
+    # Seconds since the first event in the file
+    seconds = (dates - dates[0]) / np.timedelta64(1, "s")
+    return group_events(seconds, amounts)
+
+
+def get_file_key(path) -> str:
+    """
+    Get a key identifying the contents of `path` (size, mtime and hash).
+    """
+    st = os.stat(path)
+    with open(path, "rb") as f:
+        digest = hashlib.file_digest(f, "blake2b").hexdigest()
+    return f"{st.st_size}:{st.st_mtime_ns}:{digest}"
+
+
+def load_events(path, cache_path=None):
+    """
+    Like `read_events`, but use (and update) an `.npz` cache of the
+    grouped event arrays at `cache_path`, if given.
+    """
+    if not cache_path:
+        return read_events(path)
+    key = get_file_key(path)
+    try:
+        with np.load(cache_path) as data:
+            if str(data["key"]) == key:
+                print(f"Using cached events from {cache_path}")
+                return data["times"], data["counts"], data["values"]
+    except (OSError, KeyError, ValueError):
+        pass
+    times, counts, values = read_events(path)
+    tmp_path = Path(f"{cache_path}.tmp")
+    with tmp_path.open("wb") as f:
+        np.savez(f, key=key, times=times, counts=counts, values=values)
+    tmp_path.replace(cache_path)
+    return times, counts, values
+
+
+def expand_groups(times, counts, values):
+    """
+    Spread each group's events evenly over the time until the next group
+    (or a minute, for the last group), returning `(x, y)` arrays.
+    """
+    next_times = np.append(times[1:], times[-1] + 60)
+    group_index = np.repeat(np.arange(len(times)), counts)
+    starts = np.cumsum(counts) - counts
+    offsets = np.arange(len(values)) - starts[group_index]
+    x = (
+        times[group_index]
+        + offsets / counts[group_index] * (next_times - times)[group_index]
+    )
+    return x, values
 
 
 def next_power_of_2(x):
     return 1 << (x - 1).bit_length()
 
 
+def iter_resampled(x, y, num_samples, *, chunk_samples):
+    """
+    Yield `np.interp(np.linspace(x.min(), x.max(), num_samples), x, y)`
+    in chunks of `chunk_samples`.
+    """
+    start = np.min(x)
+    stop = np.max(x)
+    step = (stop - start) / (num_samples - 1) if num_samples > 1 else 0
+    for k0 in range(0, num_samples, chunk_samples):
+        k1 = min(k0 + chunk_samples, num_samples)
+        # Computed like `np.linspace` does, so the result is identical
+        xnew = np.arange(k0, k1) * step + start
+        if k1 == num_samples:
+            xnew[-1] = stop
+        yield np.interp(xnew, x, y)
+
+
+def write_wav(path, rate, x, y, num_samples, *, chunk_samples=CHUNK_SAMPLES):
+    """
+    Resample `(x, y)` to `num_samples` samples, normalize to the full 16-bit range
+    and write it as a WAV file, in two passes over bounded-size chunks.
+    """
+    ymin = np.inf
+    ymax = -np.inf
+    for ynew in iter_resampled(x, y, num_samples, chunk_samples=chunk_samples):
+        ymin = min(ymin, np.min(ynew))
+        ymax = max(ymax, np.max(ynew))
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        for ynew in iter_resampled(x, y, num_samples, chunk_samples=chunk_samples):
+            ynew -= ymin
+            ynew /= ymax - ymin
+            ynew *= 65535
+            ynew -= 32768
+            wav.writeframes(ynew.astype("<i2").tobytes())
+
+
+def parse_length(value: str) -> int | None:
+    if value == "auto":
+        return None
+    return int(value)
+
+
 def main():
-    aps = read_events()
-    print(f"Read {len(aps)} event groups")
-    aps_r = list(expand_groups(aps))
-    print(f"Expanded event groups into {len(aps_r)} samples")
-    x, y = zip(*aps_r)
-    num_samples = next_power_of_2(len(x))
-    print(f"Resampling to {num_samples} samples")
-    xnew = np.linspace(np.min(x), np.max(x), num=num_samples)
-    ynew = np.interp(xnew, x, y)
-    ynew -= np.min(ynew)
-    ynew /= np.max(ynew)
-    ynew *= 65535
-    ynew -= 32768
-    ynew = ynew.astype(np.int16)
-    scipy.io.wavfile.write(f"cashflow_{num_samples}.wav", 44100, ynew)
+    ap = argparse.ArgumentParser()
+    ap.add_argument("input", nargs="?", default="cashflow.csv")
+    ap.add_argument(
+        "-r",
+        "--rate",
+        dest="rates",
+        type=int,
+        action="append",
+        help="sample rate(s) to render (default 44100)",
+    )
+    ap.add_argument(
+        "-n",
+        "--length",
+        dest="lengths",
+        type=parse_length,
+        action="append",
+        help="length(s) in samples to render; 'auto' is the next power of 2 "
+        "from the number of events (default)",
+    )
+    ap.add_argument(
+        "--cache",
+        help="cache for the parsed events (default: input path + .npz)",
+    )
+    ap.add_argument("--no-cache", action="store_true")
+    ap.add_argument(
+        "-o",
+        "--output",
+        help="output filename template; {stem}, {samples} and {rate} are "
+        "replaced (default: {stem}_{samples}.wav, "
+        "or {stem}_{samples}_{rate}.wav for multiple rates)",
+    )
+    args = ap.parse_args()
+    rates = args.rates or [44100]
+    lengths = args.lengths or [None]
+    output = args.output or (
+        "{stem}_{samples}.wav" if len(rates) == 1 else "{stem}_{samples}_{rate}.wav"
+    )
+    cache_path = None if args.no_cache else (args.cache or f"{args.input}.npz")
+
+    times, counts, values = load_events(args.input, cache_path)
+    print(f"Read {len(times)} event groups")
+    x, y = expand_groups(times, counts, values)
+    print(f"Expanded event groups into {len(x)} samples")
+    stem = Path(args.input).stem
+    for num_samples in dict.fromkeys(n or next_power_of_2(len(x)) for n in lengths):
+        for rate in rates:
+            path = output.format(stem=stem, samples=num_samples, rate=rate)
+            print(f"Resampling to {num_samples} samples at {rate} Hz: {path}")
+            write_wav(path, rate, x, y, num_samples)
 
 
 if __name__ == "__main__":
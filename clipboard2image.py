@@ -7,26 +7,209 @@
 # ///
 
 import argparse
+import dataclasses
 import io
+import json
+import math
+import os
 import pathlib
+import socket
 import subprocess
+import sys
+import stat
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from PIL import ImageGrab, Image
 from rich.progress import Progress
 
 
+def psnr_from_arrays(ref, arr, max_value=255) -> float:
+    """
+    Calculate the PSNR between two uint8 arrays of the same shape
+    using exact integer math (and a single temporary array).
+    """
+    import numpy as np
+
+    diff = np.subtract(ref, arr, dtype=np.int32)
+    np.multiply(diff, diff, out=diff)
+    sse = int(diff.sum(dtype=np.int64))
+    if sse == 0:
+        return 100
+    mse = sse / diff.size
+    return 20 * math.log10(max_value / math.sqrt(mse))
+
+
 def calculate_psnr(img1, img2, max_value=255):
     """ "Calculating peak signal-to-noise ratio (PSNR) between two images."""
     import numpy as np
 
-    mse = np.mean(
-        (np.array(img1, dtype=np.float32) - np.array(img2, dtype=np.float32)) ** 2,
-    )
-    if mse == 0:
-        return 100
-    return 20 * np.log10(max_value / (np.sqrt(mse)))
+    return psnr_from_arrays(np.asarray(img1), np.asarray(img2), max_value=max_value)
+
+
+class QualitySearch:
+    """
+    Searches for the lowest encoder quality whose output reaches a target PSNR.
+
+    The reference array is converted only once, probe encodes are not
+    `optimize`d (that only shrinks Huffman tables and doesn't affect PSNR),
+    and each probe's encoded bytes and PSNR are cached by quality.
+    """
+
+    def __init__(
+        self,
+        im: Image.Image,
+        *,
+        format: str = "jpeg",
+        min_quality: int = 5,
+        max_quality: int = 99,
+    ):
+        import numpy as np
+
+        if format != "jpeg":
+            raise ValueError(f"Unsupported format: {format}")
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        self.im = im
+        self.format = format
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.reference = np.asarray(im)
+        self.probes: dict[int, tuple[bytes, float]] = {}
+        self._owner = threading.current_thread()
+        self._local = threading.local()
+
+    def get_image(self) -> Image.Image:
+        """
+        Get the image to encode in the current thread.
+
+        Pillow keeps save parameters on the image object while saving,
+        so concurrent saves of one image pick up each other's quality;
+        other threads get a copy of their own.
+        """
+        if threading.current_thread() is self._owner:
+            return self.im
+        im = getattr(self._local, "im", None)
+        if im is None:
+            im = self._local.im = self.im.copy()
+        return im
+
+    def encode(self, quality: int, **kwargs) -> bytes:
+        bio = io.BytesIO()
+        self.get_image().save(bio, format=self.format, quality=quality, **kwargs)
+        return bio.getvalue()
+
+    def probe(self, quality: int) -> float:
+        """Encode at `quality` and return the resulting PSNR."""
+        import numpy as np
+
+        if quality not in self.probes:
+            data = self.encode(quality)
+            with Image.open(io.BytesIO(data)) as im2:
+                psnr = psnr_from_arrays(self.reference, np.asarray(im2))
+            self.probes[quality] = (data, psnr)
+        return self.probes[quality][1]
+
+    def bracket(self, target_psnr: float) -> tuple[int, int]:
+        """
+        Get the highest probed quality below the target and the lowest one reaching it;
+        either may be just outside the quality range if not known yet.
+        """
+        below = [q for q, (_, psnr) in self.probes.items() if psnr < target_psnr]
+        above = [q for q, (_, psnr) in self.probes.items() if psnr >= target_psnr]
+        lo = max(below, default=self.min_quality - 1)
+        hi = min(above, default=self.max_quality + 1)
+        return lo, hi
+
+    def next_qualities(self, target_psnr: float, n: int) -> list[int]:
+        """
+        Get up to `n` not-yet-probed qualities spread evenly within the current bracket.
+        """
+        lo, hi = self.bracket(target_psnr)
+        span = hi - lo
+        qualities = {lo + round(span * (i + 1) / (n + 1)) for i in range(n)}
+        return sorted(q for q in qualities if lo < q < hi and q not in self.probes)
+
+    def next_quality(self, target_psnr: float) -> int | None:
+        """
+        Pick the next quality to probe by interpolating PSNR vs. quality
+        between the closest probes on either side of the target
+        (falling back to bisection), or None if there's nothing left to try.
+        """
+        lo, hi = self.bracket(target_psnr)
+        if hi - lo <= 1:
+            return None
+        if lo in self.probes and hi in self.probes:
+            # Target is bracketed: interpolate between the bracket ends
+            (q1, q2) = (lo, hi)
+        elif len(self.probes) >= 2:
+            # Target is on one side of all probes: extrapolate from the two nearest
+            (q1, q2) = sorted(
+                self.probes,
+                key=lambda q: abs(self.probes[q][1] - target_psnr),
+            )[:2]
+        else:
+            (q1, q2) = (None, None)
+        p1 = self.probes[q1][1] if q1 is not None else None
+        p2 = self.probes[q2][1] if q2 is not None else None
+        if p1 is not None and p1 != p2:
+            quality = q1 + round((target_psnr - p1) * (q2 - q1) / (p2 - p1))
+        else:
+            quality = (max(lo, self.min_quality) + min(hi, self.max_quality)) // 2
+        # Always make progress within the bracket
+        return min(max(quality, lo + 1), hi - 1)
+
+    def best_quality(self, target_psnr: float) -> int:
+        """The lowest probed quality reaching the target, or the highest probed one."""
+        above = [q for q, (_, psnr) in self.probes.items() if psnr >= target_psnr]
+        return min(above) if above else max(self.probes)
+
+
+def probe_in_parallel(
+    progress: Progress,
+    psnr_task,
+    search: QualitySearch,
+    target_psnr: float,
+    *,
+    n_probes: int,
+    max_rounds: int,
+    tolerance: float,
+) -> int | None:
+    """
+    Probe `n_probes` qualities at a time on a thread pool (Pillow's codecs
+    and numpy release the GIL): first spread over the whole quality range,
+    then spread within the narrowed bracket around the target.
+
+    Returns the probed quality closest to the target if it's within tolerance.
+    """
+
+    def run_probe(quality):
+        probe_task = progress.add_task(f"  Probing {quality=}...", total=1)
+        psnr = search.probe(quality)
+        progress.update(
+            probe_task,
+            completed=1,
+            description=f"  Probed {quality=}, {psnr=:.2f}",
+        )
+        progress.update(psnr_task, advance=1)
+        return quality, psnr
+
+    with ThreadPoolExecutor(max_workers=n_probes) as executor:
+        for _ in range(max_rounds):
+            qualities = search.next_qualities(target_psnr, n_probes)
+            if not qualities:
+                break
+            results = list(executor.map(run_probe, qualities))
+            quality, psnr = min(results, key=lambda qp: abs(qp[1] - target_psnr))
+            progress.update(
+                psnr_task,
+                description=f"Encoding to target PSNR {target_psnr}... {quality=}, {psnr=:.2f}",
+            )
+            if abs(psnr - target_psnr) < tolerance:
+                return quality
+    return None
 
 
 def encode_to_target_psnr(
@@ -35,86 +218,358 @@ def encode_to_target_psnr(
     target_psnr: float,
     format: str,
     max_steps: int = 10,
+    tolerance: float = 2,
+    optimize: bool = False,
+    parallel_probes: int = 0,
 ):
-    """Encode an image to a target PSNR."""
-    if format != "jpeg":
-        raise ValueError(f"Unsupported format: {format}")
+    """
+    Encode an image to a target PSNR.
+
+    With `parallel_probes`, that many qualities are probed concurrently per round,
+    for enough rounds to cover `max_steps` probes but at least two (a spread over
+    the whole range, then one around the target); otherwise probes are sequential.
+
+    The chosen quality's cached probe encode is returned as-is, unless `optimize`
+    is set, in which case it's encoded once more with `optimize=True`.
+    """
+    search = QualitySearch(im, format=format)
     psnr_task = progress.add_task("Encoding to target PSNR...", total=max_steps)
 
-    min_quality = 5
-    max_quality = 99
-    bio = None
     try:
+        quality = None
+        if parallel_probes > 1:
+            max_rounds = max(2, math.ceil(max_steps / parallel_probes))
+            progress.update(psnr_task, total=max_rounds * parallel_probes)
+            quality = probe_in_parallel(
+                progress,
+                psnr_task,
+                search,
+                target_psnr,
+                n_probes=parallel_probes,
+                max_rounds=max_rounds,
+                tolerance=tolerance,
+            )
+            max_steps = 0  # No sequential probes after this
         for step in range(max_steps):
-            quality = (min_quality + max_quality) // 2
-            bio = io.BytesIO()
-            im.save(bio, format="jpeg", quality=quality, optimize=True)
-            bio.seek(0)
-            with Image.open(bio) as im2:
-                psnr = calculate_psnr(im, im2)
+            probe_quality = search.next_quality(target_psnr)
+            if probe_quality is None:
+                break
+            psnr = search.probe(probe_quality)
             progress.update(
                 psnr_task,
                 advance=1,
-                description=f"Encoding to target PSNR {target_psnr}... {quality=}, {psnr=:.2f}",
+                description=f"Encoding to target PSNR {target_psnr}... quality={probe_quality}, {psnr=:.2f}",
             )
-            if abs(psnr - target_psnr) < 2:
+            if abs(psnr - target_psnr) < tolerance:
+                quality = probe_quality
                 break
-            if psnr < target_psnr:
-                min_quality = quality
-            else:
-                max_quality = quality
-            if max_quality - min_quality <= 1:
-                break
-        bio.seek(0)
-        return bio.getvalue()
+        if quality is None:
+            quality = search.best_quality(target_psnr)
+        if optimize:
+            return search.encode(quality, optimize=True)
+        return search.probes[quality][0]
 
     finally:
         progress.update(psnr_task, completed=1)
 
 
-def do_the_thing(*, progress: Progress, format: str):
-    main_task = progress.add_task("Converting...", total=5)
-    progress.update(main_task, description="Grabbing clipboard...", advance=1)
-    im = ImageGrab.grabclipboard()
-    if not im:
-        raise ValueError("No image found in clipboard")
-    outname = pathlib.Path.home() / "Desktop" / f"cb-{int(time.time())}.{format}"
+@dataclasses.dataclass(frozen=True)
+class EncodeOptions:
+    format: str = "webp"
+    target_psnr: float = 45
+    parallel_probes: int = 0
+    jpeg_optimize: bool = False
+    webp_backend: str = "pillow"
+    webp_mode: str = "lossy"
+    webp_quality: int = 95
+    webp_method: int = 4
+
+
+def encode_webp(im: Image.Image, *, lossless: bool, quality: int, method: int) -> bytes:
+    if im.mode not in ("RGB", "RGBA"):
+        im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+    bio = io.BytesIO()
+    im.save(bio, format="webp", lossless=lossless, quality=quality, method=method)
+    return bio.getvalue()
+
+
+def encode_webp_smallest(im: Image.Image, *, quality: int, method: int) -> bytes:
+    """
+    Encode both lossy and lossless WebP concurrently, and return the smaller one;
+    lossless often wins for screenshots with large flat areas.
+    """
+    # Each encode gets its own image object, as concurrent saves of one interfere
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        lossy, lossless = executor.map(
+            lambda im, lossless: encode_webp(
+                im,
+                lossless=lossless,
+                quality=quality,
+                method=method,
+            ),
+            (im, im.copy()),
+            (False, True),
+        )
+    return min(lossy, lossless, key=len)
+
+
+def encode_webp_cwebp(im: Image.Image, outname: pathlib.Path, *, quality: int):
     with tempfile.NamedTemporaryFile(suffix=".ppm") as f:
-        if format == "webp":
+        im.save(f.name)
+        subprocess.run(["cwebp", "-q", str(quality), "-mt", f.name, "-o", str(outname)])
+
+
+def encode_image(
+    *,
+    progress: Progress,
+    main_task,
+    im: Image.Image,
+    outname: pathlib.Path,
+    options: EncodeOptions,
+):
+    format = options.format
+    if format == "webp":
+        if options.webp_backend == "cwebp":
             progress.update(
                 main_task,
-                description=f"Saving {im.size} ({im.format}) to temp file...",
+                description=f"Converting {im.size} ({im.format}) to webp with cwebp...",
                 advance=1,
             )
-            im.save(f.name)
+            encode_webp_cwebp(im, outname, quality=options.webp_quality)
+        else:
             progress.update(
                 main_task,
-                description="Converting to webp...",
+                description=f"Encoding {im.size} ({im.format}) to {options.webp_mode} webp...",
                 advance=1,
             )
-            subprocess.run(["cwebp", "-q", "95", "-mt", f.name, "-o", str(outname)])
-        elif format == "jpeg":
-            jpeg_bytes = encode_to_target_psnr(
-                progress,
-                im,
-                target_psnr=45,
-                format="jpeg",
-            )
+            if options.webp_mode == "smallest":
+                webp_bytes = encode_webp_smallest(
+                    im,
+                    quality=options.webp_quality,
+                    method=options.webp_method,
+                )
+            else:
+                webp_bytes = encode_webp(
+                    im,
+                    lossless=(options.webp_mode == "lossless"),
+                    quality=options.webp_quality,
+                    method=options.webp_method,
+                )
             progress.update(
                 main_task,
                 description="Writing to output file...",
                 advance=1,
             )
-            outname.write_bytes(jpeg_bytes)
-        elif format == "png":
-            progress.update(
-                main_task,
-                description="Saving to output file...",
-                advance=1,
-            )
-            im.save(outname, format="png", optimize=True, compress_level=9)
+            outname.write_bytes(webp_bytes)
+    elif format == "jpeg":
+        jpeg_bytes = encode_to_target_psnr(
+            progress,
+            im,
+            target_psnr=options.target_psnr,
+            format="jpeg",
+            optimize=options.jpeg_optimize,
+            parallel_probes=options.parallel_probes,
+        )
+        progress.update(
+            main_task,
+            description="Writing to output file...",
+            advance=1,
+        )
+        outname.write_bytes(jpeg_bytes)
+    elif format == "png":
+        progress.update(
+            main_task,
+            description="Saving to output file...",
+            advance=1,
+        )
+        im.save(outname, format="png", optimize=True, compress_level=9)
+    else:
+        raise ValueError(f"Unknown format: {format}")
+
+
+def grab_clipboard() -> Image.Image:
+    im = ImageGrab.grabclipboard()
+    if not im:
+        raise ValueError("No image found in clipboard")
+    return im
+
+
+def get_clipboard_outname(options: EncodeOptions) -> pathlib.Path:
+    return pathlib.Path.home() / "Desktop" / f"cb-{int(time.time())}.{options.format}"
+
+
+def load_image(source: str) -> Image.Image:
+    """Load an image from a path, or from stdin if `source` is "-"."""
+    if source == "-":
+        im = Image.open(io.BytesIO(sys.stdin.buffer.read()))
+    else:
+        im = Image.open(source)
+    im.load()
+    return im
+
+
+def get_batch_outname(
+    source: str,
+    index: int,
+    options: EncodeOptions,
+    output_dir: pathlib.Path | None,
+) -> pathlib.Path:
+    if source == "-":
+        stem = f"stdin-{int(time.time())}-{index}"
+        output_dir = output_dir or pathlib.Path.cwd()
+    else:
+        source_path = pathlib.Path(source)
+        stem = source_path.stem
+        output_dir = output_dir or source_path.parent
+    outname = output_dir / f"{stem}.{options.format}"
+    if source != "-" and outname.resolve() == pathlib.Path(source).resolve():
+        # Never overwrite the input
+        outname = output_dir / f"{stem}.c2i.{options.format}"
+    return outname
+
+
+def convert_sources(
+    *,
+    progress: Progress,
+    sources: list[str],
+    options: EncodeOptions,
+    output_dir: pathlib.Path | None = None,
+):
+    """Convert a batch of images (paths, or "-" for stdin) in this process."""
+    for index, source in enumerate(sources):
+        start = time.perf_counter()
+        task = progress.add_task(f"Reading {source}...", total=3)
+        im = load_image(source)
+        progress.update(task, advance=1)
+        outname = get_batch_outname(source, index, options, output_dir)
+        encode_image(
+            progress=progress,
+            main_task=task,
+            im=im,
+            outname=outname,
+            options=options,
+        )
+        duration = time.perf_counter() - start
+        progress.update(
+            task,
+            description=f"{source} -> {outname} ({outname.stat().st_size} bytes, {duration * 1000:.0f} ms)",
+            completed=3,
+        )
+
+
+def remove_stale_socket(socket_path: str):
+    """
+    Remove a socket left behind by a server that's no longer running;
+    raise if something else is at `socket_path` or a server is still listening.
+    """
+    try:
+        st = os.stat(socket_path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise FileExistsError(f"{socket_path} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+            return
+    raise FileExistsError(f"A server is already listening on {socket_path}")
+
+
+def handle_request(
+    request: str,
+    *,
+    progress: Progress,
+    options: EncodeOptions,
+    output_dir: pathlib.Path | None,
+) -> dict:
+    """Convert the clipboard (for an empty request) or an image path; return a reply."""
+    start = time.perf_counter()
+    task = progress.add_task(f"Converting {request or 'clipboard'}...", total=3)
+    try:
+        if request == "-":
+            # That would be the server's own stdin
+            raise ValueError("Reading from stdin is not supported in server mode")
+        if request:
+            im = load_image(request)
+            outname = get_batch_outname(request, 0, options, output_dir)
         else:
-            raise ValueError(f"Unknown format: {format}")
+            im = grab_clipboard()
+            outname = get_clipboard_outname(options)
+        encode_image(
+            progress=progress,
+            main_task=task,
+            im=im,
+            outname=outname,
+            options=options,
+        )
+        return {
+            "output": str(outname),
+            "size": outname.stat().st_size,
+            "seconds": time.perf_counter() - start,
+        }
+    except Exception as exc:
+        return {"error": str(exc)}
+    finally:
+        progress.remove_task(task)
+
+
+def serve(
+    *,
+    progress: Progress,
+    socket_path: str,
+    options: EncodeOptions,
+    output_dir: pathlib.Path | None = None,
+):
+    """
+    Serve conversion requests on a Unix socket, keeping modules and encoders warm.
+
+    Each request is a line: an empty line converts the clipboard, anything else is
+    an image path. Each request gets a JSON line in reply, e.g. `echo | nc -U SOCKET`.
+    """
+    import numpy  # noqa: F401 (warm up for the PSNR search)
+
+    remove_stale_socket(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(socket_path)
+        server.listen()
+        progress.console.print(f"Listening on {socket_path}")
+        try:
+            while True:
+                conn, _ = server.accept()
+                try:
+                    with conn, conn.makefile("rwb") as f:
+                        for line in f:
+                            request = line.decode().strip()
+                            reply = handle_request(
+                                request,
+                                progress=progress,
+                                options=options,
+                                output_dir=output_dir,
+                            )
+                            progress.console.print(f"{request or 'clipboard'}: {reply}")
+                            f.write(json.dumps(reply).encode() + b"\n")
+                            f.flush()
+                except OSError as exc:
+                    # e.g. the client went away before reading its reply
+                    progress.console.print(f"Connection error: {exc}")
+        finally:
+            os.unlink(socket_path)
+
+
+def do_the_thing(*, progress: Progress, options: EncodeOptions):
+    main_task = progress.add_task("Converting...", total=5)
+    progress.update(main_task, description="Grabbing clipboard...", advance=1)
+    im = grab_clipboard()
+    outname = get_clipboard_outname(options)
+    encode_image(
+        progress=progress,
+        main_task=main_task,
+        im=im,
+        outname=outname,
+        options=options,
+    )
     progress.update(main_task, description="Opening output file...", advance=1)
     subprocess.run(["open", "-R", str(outname)])
     progress.update(main_task, description="Done", completed=1)
@@ -122,10 +577,83 @@ def do_the_thing(*, progress: Progress, format: str):
 
 def main():
     ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "inputs",
+        nargs="*",
+        help="Image files (or - for stdin) to convert instead of the clipboard",
+    )
     ap.add_argument("-f", "--format", choices=("webp", "jpeg", "png"), default="webp")
+    ap.add_argument(
+        "-o",
+        "--output-dir",
+        type=pathlib.Path,
+        default=None,
+        help="Output directory for converted files (default: next to the input)",
+    )
+    ap.add_argument(
+        "--serve",
+        metavar="SOCKET",
+        default=None,
+        help="Stay running, converting images as requested on this Unix socket",
+    )
+    ap.add_argument(
+        "-P",
+        "--parallel-probes",
+        type=int,
+        default=0,
+        help="Number of JPEG qualities to probe concurrently (default: sequential search)",
+    )
+    ap.add_argument(
+        "--jpeg-optimize",
+        action="store_true",
+        help="Re-encode the chosen JPEG quality with optimized Huffman tables "
+        "(slightly smaller, one more encode)",
+    )
+    ap.add_argument("--webp-backend", choices=("pillow", "cwebp"), default="pillow")
+    ap.add_argument(
+        "--webp-mode",
+        choices=("lossy", "lossless", "smallest"),
+        default="lossy",
+        help="'smallest' encodes both concurrently and keeps the smaller one",
+    )
+    ap.add_argument("--webp-quality", type=int, default=95)
+    ap.add_argument(
+        "--webp-method",
+        type=int,
+        default=4,
+        choices=range(7),
+        help="WebP encoder effort, 0 (fast) to 6 (slow)",
+    )
     args = ap.parse_args()
+    options = EncodeOptions(
+        format=args.format,
+        parallel_probes=args.parallel_probes,
+        jpeg_optimize=args.jpeg_optimize,
+        webp_backend=args.webp_backend,
+        webp_mode=args.webp_mode,
+        webp_quality=args.webp_quality,
+        webp_method=args.webp_method,
+    )
+    if args.output_dir:
+        # Create it up front rather than failing after encoding
+        args.output_dir.mkdir(parents=True, exist_ok=True)
     with Progress() as progress:
-        do_the_thing(progress=progress, format=args.format)
+        if args.serve:
+            serve(
+                progress=progress,
+                socket_path=args.serve,
+                options=options,
+                output_dir=args.output_dir,
+            )
+        elif args.inputs:
+            convert_sources(
+                progress=progress,
+                sources=args.inputs,
+                options=options,
+                output_dir=args.output_dir,
+            )
+        else:
+            do_the_thing(progress=progress, options=options)
 
 
 if __name__ == "__main__":
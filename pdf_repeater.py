@@ -2,19 +2,27 @@
 Takes a PDF file and a TSV specification file,
 and separates the PDF file's pages into individual files,
 each of which repeats the page as specified in the TSV file.
+
+By default, this uses poppler-utils and Ghostscript;
+`--engine=pypdf` does the work in-process with pypdf instead.
 """
 
 import argparse
 import asyncio
 import csv
 import dataclasses
+import hashlib
+import json
+import os
 import pathlib
 import re
 import shlex
 import shutil
 import tempfile
+import time
 
 SEPARATED_PATTERN = "sep_%08d.pdf"
+CACHE_NAME = ".pdf_repeater_cache.json"
 
 
 async def print_and_check_call(args):
@@ -22,12 +30,53 @@ async def print_and_check_call(args):
     cmd = shlex.join(args)
     print("=>", cmd)
     proc = await asyncio.create_subprocess_shell(cmd)
-    await proc.wait()
+    try:
+        await proc.wait()
+    except asyncio.CancelledError:
+        # Don't leave orphaned processes behind when another job has failed
+        proc.kill()
+        await proc.wait()
+        raise
     if proc.returncode != 0:
         raise RuntimeError(f"Command failed: {cmd}")
     return proc.returncode
 
 
+class Scheduler:
+    """
+    Limits the number of concurrently running subprocesses,
+    keeping track of how long jobs spent queued vs. running.
+    """
+
+    def __init__(self, jobs: int):
+        self.jobs = jobs
+        self.semaphore = asyncio.Semaphore(jobs)
+        self.queued_times = []
+        self.run_times = []
+
+    async def check_call(self, args):
+        queued_at = time.perf_counter()
+        async with self.semaphore:
+            started_at = time.perf_counter()
+            try:
+                return await print_and_check_call(args)
+            finally:
+                self.queued_times.append(started_at - queued_at)
+                self.run_times.append(time.perf_counter() - started_at)
+
+    def print_stats(self):
+        n = len(self.run_times)
+        if not n:
+            return
+        print(
+            f"{n} jobs ({self.jobs} at a time): "
+            f"queued {sum(self.queued_times):.1f} s "
+            f"(avg {sum(self.queued_times) / n:.2f} s, max {max(self.queued_times):.2f} s), "
+            f"ran {sum(self.run_times):.1f} s "
+            f"(avg {sum(self.run_times) / n:.2f} s, max {max(self.run_times):.2f} s)",
+        )
+
+
 @dataclasses.dataclass
 class PageSpec:
     page: int
@@ -50,20 +99,123 @@ def read_page_specs(args):
     return page_specs
 
 
+def hash_file(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class OutputCache:
+    """
+    Sidecar file mapping output filenames to a fingerprint of what they were made from,
+    so unchanged outputs can be skipped.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.fingerprints = {}
+
+    def load(self):
+        if self.path.is_file():
+            self.fingerprints = json.loads(self.path.read_text())
+        return self
+
+    def save(self):
+        temp_path = self.path.with_suffix(".tmp")
+        temp_path.write_text(json.dumps(self.fingerprints, indent=2, sort_keys=True))
+        temp_path.replace(self.path)
+
+    def is_current(self, filename: str, fingerprint: str) -> bool:
+        return (
+            self.fingerprints.get(filename) == fingerprint
+            and (self.path.parent / filename).is_file()
+        )
+
+    def record(self, filename: str, fingerprint: str):
+        self.fingerprints[filename] = fingerprint
+
+    def forget(self, filename: str):
+        self.fingerprints.pop(filename, None)
+
+
+def get_fingerprint(*, input_hash: str, page_spec: PageSpec, engine: str) -> str:
+    data = [input_hash, page_spec.page, page_spec.repeats, page_spec.title, engine]
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+
+def get_page_ranges(pages) -> list[tuple[int, int]]:
+    """
+    Get the runs of consecutive pages (as inclusive `(first, last)` pairs) in `pages`.
+    """
+    ranges = []
+    for page in sorted(set(pages)):
+        if ranges and ranges[-1][1] == page - 1:
+            ranges[-1] = (ranges[-1][0], page)
+        else:
+            ranges.append((page, page))
+    return ranges
+
+
+def get_output_filename(page_spec: PageSpec) -> str:
+    if page_spec.title:
+        return f"{page_spec.title}.pdf"
+    return f"{page_spec.page:04d}.pdf"
+
+
+def write_repeated_page_pypdf(reader, page_spec: PageSpec, output_pdf_path):
+    """
+    Write a PDF repeating a page in-process with pypdf.
+
+    The page (and its content streams and resources) is copied once;
+    the repeats are page dictionaries referring to those same objects,
+    so the output size stays roughly constant regardless of `repeats`.
+    """
+    from pypdf import PageObject, PdfWriter
+
+    writer = PdfWriter()
+    first_page = writer.add_page(reader.pages[page_spec.page - 1])
+    for _ in range(page_spec.repeats - 1):
+        page = PageObject(writer)
+        # Indirect objects already in `writer` aren't copied again when adding.
+        page.update(first_page)
+        writer.add_page(page)
+    with open(output_pdf_path, "wb") as f:
+        writer.write(f)
+
+
+def process_page_specs_pypdf(
+    *,
+    input_pdf_file: pathlib.Path,
+    page_specs: list[PageSpec],
+    output_path: pathlib.Path,
+    on_done=None,
+):
+    from pypdf import PdfReader
+
+    reader = PdfReader(input_pdf_file)
+    for page_spec in sorted(page_specs, key=lambda ps: ps.page):
+        output_pdf_path = output_path / get_output_filename(page_spec)
+        print("=>", output_pdf_path)
+        write_repeated_page_pypdf(reader, page_spec, output_pdf_path)
+        if on_done:
+            on_done(page_spec)
+
+
 async def process_single_page_spec(
     *,
     page_spec: PageSpec,
     temp_path: pathlib.Path,
     output_path: pathlib.Path,
+    scheduler: Scheduler,
+    on_done=None,
 ):
-    if page_spec.title:
-        filename = f"{page_spec.title}.pdf"
-    else:
-        filename = f"{page_spec.page:04d}.pdf"
+    filename = get_output_filename(page_spec)
     output_temp_path = temp_path / f"temp-{page_spec.page}.pdf"
     page_path = temp_path / (SEPARATED_PATTERN % page_spec.page)
     assert page_path.is_file(), f"Page file {page_path} not found"
-    await print_and_check_call(
+    await scheduler.check_call(
         [
             "pdfunite",
             *[str(page_path)] * page_spec.repeats,
@@ -71,7 +223,7 @@ async def process_single_page_spec(
         ],
     )
     output_pdf_path = output_path / filename
-    await print_and_check_call(
+    await scheduler.check_call(
         [
             "gs",
             "-dBATCH",
@@ -86,6 +238,8 @@ async def process_single_page_spec(
         ],
     )
     output_temp_path.unlink()
+    if on_done:
+        on_done(page_spec)
 
 
 async def do_process(
@@ -94,25 +248,38 @@ async def do_process(
     page_specs: list[PageSpec],
     temp_path: pathlib.Path,
     output_path: pathlib.Path,
+    scheduler: Scheduler,
+    on_done=None,
 ):
-    await print_and_check_call(
-        [
-            "pdfseparate",
-            str(input_pdf_file),
-            str(temp_path / SEPARATED_PATTERN),
-        ],
-    )
+    # Only extract the pages that are actually referenced, each only once.
+    async with asyncio.TaskGroup() as tg:
+        for first, last in get_page_ranges(ps.page for ps in page_specs):
+            tg.create_task(
+                scheduler.check_call(
+                    [
+                        "pdfseparate",
+                        "-f",
+                        str(first),
+                        "-l",
+                        str(last),
+                        str(input_pdf_file),
+                        str(temp_path / SEPARATED_PATTERN),
+                    ],
+                ),
+            )
 
-    promises = [
-        process_single_page_spec(
-            page_spec=page_spec,
-            temp_path=temp_path,
-            output_path=output_path,
-        )
-        for page_spec in sorted(page_specs, key=lambda ps: ps.page)
-    ]
-
-    await asyncio.gather(*promises)
+    # The first failure cancels (and kills) all remaining jobs.
+    async with asyncio.TaskGroup() as tg:
+        for page_spec in sorted(page_specs, key=lambda ps: ps.page):
+            tg.create_task(
+                process_single_page_spec(
+                    page_spec=page_spec,
+                    temp_path=temp_path,
+                    output_path=output_path,
+                    scheduler=scheduler,
+                    on_done=on_done,
+                ),
+            )
 
 
 async def main():
@@ -123,23 +290,114 @@ async def main():
     ap.add_argument("--page-no-column", default="page_no")
     ap.add_argument("--repeats-column", default="repeats")
     ap.add_argument("--title-column", default=None)
+    ap.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate all outputs, even if they seem current",
+    )
+    ap.add_argument(
+        "--prune",
+        action="store_true",
+        help="Delete previously generated outputs no longer in the spec",
+    )
+    ap.add_argument(
+        "--engine",
+        choices=("pdfunite", "pypdf"),
+        default="pdfunite",
+        help="pdfunite: poppler + Ghostscript; pypdf: in-process, sharing page content",
+    )
+    ap.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Maximum number of concurrent pdfunite/gs processes",
+    )
     args = ap.parse_args()
 
     page_specs = read_page_specs(args)
-
-    temp_path = pathlib.Path(tempfile.mkdtemp())
+    input_pdf_file = pathlib.Path(args.pdf_file)
     output_path = pathlib.Path(args.output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
 
+    cache = OutputCache(output_path / CACHE_NAME).load()
+    input_hash = hash_file(input_pdf_file)
+    fingerprints = {
+        get_output_filename(ps): get_fingerprint(
+            input_hash=input_hash,
+            page_spec=ps,
+            engine=args.engine,
+        )
+        for ps in page_specs
+    }
+
+    for filename in sorted(set(cache.fingerprints) - set(fingerprints)):
+        if args.prune:
+            print("Pruning stale output:", filename)
+            (output_path / filename).unlink(missing_ok=True)
+            cache.forget(filename)
+        else:
+            print("Stale output (use --prune to delete):", filename)
+
+    if not args.force:
+        n_total = len(page_specs)
+        page_specs = [
+            ps
+            for ps in page_specs
+            if not cache.is_current(
+                get_output_filename(ps),
+                fingerprints[get_output_filename(ps)],
+            )
+        ]
+        print(f"{n_total - len(page_specs)} of {n_total} outputs are up to date")
+
+    def on_done(page_spec: PageSpec):
+        filename = get_output_filename(page_spec)
+        cache.record(filename, fingerprints[filename])
+
+    try:
+        if args.engine == "pypdf":
+            process_page_specs_pypdf(
+                input_pdf_file=input_pdf_file,
+                page_specs=page_specs,
+                output_path=output_path,
+                on_done=on_done,
+            )
+        elif page_specs:
+            await process_with_tools(
+                input_pdf_file=input_pdf_file,
+                page_specs=page_specs,
+                output_path=output_path,
+                jobs=args.jobs,
+                on_done=on_done,
+            )
+    finally:
+        cache.save()
+
+
+async def process_with_tools(
+    *,
+    input_pdf_file: pathlib.Path,
+    page_specs: list[PageSpec],
+    output_path: pathlib.Path,
+    jobs: int,
+    on_done,
+):
+    temp_path = pathlib.Path(tempfile.mkdtemp())
+    scheduler = Scheduler(jobs=max(1, jobs))
+
     try:
         await do_process(
-            input_pdf_file=pathlib.Path(args.pdf_file),
+            input_pdf_file=input_pdf_file,
             page_specs=page_specs,
             temp_path=temp_path,
             output_path=output_path,
+            scheduler=scheduler,
+            on_done=on_done,
         )
     finally:
         shutil.rmtree(temp_path)
+        scheduler.print_stats()
 
 
 if __name__ == "__main__":
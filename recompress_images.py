@@ -4,33 +4,265 @@ a directory tree full of JPEG files into another tree.
 
 It depends on graphicsmagick, jpeg-archive and jpegoptim.
 If you're using macOS, you can find these in Homebrew.
+Alternatively, `--engine=pillow` does everything in-process with Pillow.
+PNGs are losslessly optimized with Pillow, and `--output-format` can be
+used to convert everything to WebP or AVIF instead.
+
+A manifest in the output directory records which sources have been
+processed with which settings, so re-runs only redo changed images.
 """
 
 import argparse
-import functools
+import collections
+import contextlib
+import fcntl
+import hashlib
+import heapq
+import io
+import itertools
 import json
+import math
 import os
+import queue
 import shutil
 import subprocess
-import multiprocessing.dummy as mp
+import sys
+import threading
 import time
-from PIL import Image
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from PIL import Image, ImageChops, ImageStat
 
 import tqdm
 
+try:
+    import pillow_avif  # noqa: F401 (registers AVIF support for Pillow < 11.2)
+except ImportError:
+    pass
 
-def process_image(args, relpath):
-    input_path = os.path.join(args.input_directory, relpath)
-    output_path = os.path.join(args.output_directory, relpath)
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+MANIFEST_NAME = ".recompress-manifest.jsonl"
+IMAGE_FORMATS = {".jpg", ".jpeg", ".png"}
 
-    orig_size = os.stat(input_path).st_size
-    resized = False
+EXECUTORS = {
+    "thread": ThreadPoolExecutor,
+    "process": ProcessPoolExecutor,
+}
+# Automatic chunking aims for chunks that take about this long to process...
+AUTO_CHUNK_SECONDS = 0.2
+# ... but never gets larger than this, so stragglers can't hog a worker for long.
+MAX_AUTO_CHUNKSIZE = 64
+
+
+def get_pipeline_params(args) -> dict:
+    """
+    Get the settings that affect the output of `process_image`;
+    a change in any of these invalidates manifest entries.
+    """
+    params = {
+        "max_size": args.max_size,
+        "engine": args.engine,
+        "output_format": args.output_format,
+    }
+    if args.output_format != "keep":
+        params["output_quality"] = get_output_quality(args)
+    if args.engine == "pillow":
+        params.update(
+            target_psnr=args.target_psnr,
+            min_quality=args.min_quality,
+            max_quality=args.max_quality,
+            quality_loops=args.quality_loops,
+        )
+    return params
+
+
+def hash_file(path, bufsize=1 << 20) -> str:
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        while chunk := f.read(bufsize):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    Persistent record of which sources (by size, mtime and optionally hash)
+    have been processed with which pipeline parameters.
+
+    The file is append-only JSONL while running (later lines win),
+    and is compacted on `save()`.
+    """
+
+    def __init__(
+        self,
+        path,
+        *,
+        params: dict,
+        use_hash: bool = False,
+        adopt_existing: bool = True,
+    ):
+        self.path = path
+        self.params = params
+        self.use_hash = use_hash
+        self.adopt_existing = adopt_existing
+        self.entries = {}
+        # Sources a seed log listed, but that no longer match it
+        self.rejected = set()
+        self.n_adopted = 0
+        self._fp = None
+        # `is_current` may be called from the discovery thread
+        self._lock = threading.Lock()
 
-    if not os.path.exists(output_path):
-        with Image.open(input_path) as img:
-            width, height = img.size
+    def load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        self.entries[entry["name"]] = entry
+        except FileNotFoundError:
+            pass
+        return self
 
+    def seed_from_log(self, log_path, input_directory, output_directory) -> int:
+        """
+        Seed the manifest from a previous `recompress-log-*.jsonl`,
+        assuming it was produced with the current pipeline parameters.
+        Only entries whose source still matches the logged size
+        (and mtime, if logged) and whose output exists are added;
+        the others are never adopted as existing outputs.
+        """
+        n = 0
+        with open(log_path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                result = json.loads(line)
+                relpath = result["name"]
+                if relpath in self.entries:
+                    continue
+                output_relpath = result.get("output_name", relpath)
+                if not os.path.exists(os.path.join(output_directory, output_relpath)):
+                    self.rejected.add(relpath)
+                    continue
+                try:
+                    st = os.stat(os.path.join(input_directory, relpath))
+                except FileNotFoundError:
+                    continue
+                if st.st_size != result["orig_size"] or (
+                    result.get("orig_mtime_ns", st.st_mtime_ns) != st.st_mtime_ns
+                ):
+                    self.rejected.add(relpath)
+                    continue
+                self.rejected.discard(relpath)
+                self.record(relpath, size=st.st_size, mtime_ns=st.st_mtime_ns)
+                n += 1
+        return n
+
+    def is_current(self, relpath, input_path, output_path) -> bool:
+        entry = self.entries.get(relpath)
+        if not os.path.exists(output_path):
+            return False
+        if not entry:
+            # Output from before the manifest (or a `--no-manifest` run):
+            # trust it like the manifest-less mode would, and adopt the source.
+            if self.adopt_existing and relpath not in self.rejected:
+                return self.adopt(relpath, input_path)
+            return False
+        if entry["params"] != self.params:
+            return False
+        try:
+            st = os.stat(input_path)
+        except FileNotFoundError:
+            return False
+        if st.st_size != entry["size"]:
+            return False
+        if st.st_mtime_ns == entry["mtime_ns"]:
+            return True
+        # Touched but possibly unchanged (e.g. copied without preserving mtimes)
+        if self.use_hash and entry.get("hash"):
+            if hash_file(input_path) == entry["hash"]:
+                self.record(
+                    relpath,
+                    size=st.st_size,
+                    mtime_ns=st.st_mtime_ns,
+                    hash=entry["hash"],
+                )
+                return True
+        return False
+
+    def adopt(self, relpath, input_path) -> bool:
+        try:
+            st = os.stat(input_path)
+        except FileNotFoundError:
+            return False
+        self.record(
+            relpath,
+            size=st.st_size,
+            mtime_ns=st.st_mtime_ns,
+            hash=hash_file(input_path) if self.use_hash else None,
+        )
+        self.n_adopted += 1
+        return True
+
+    def record(self, relpath, *, size, mtime_ns, hash=None):
+        entry = {
+            "name": relpath,
+            "size": size,
+            "mtime_ns": mtime_ns,
+            "params": self.params,
+        }
+        if hash:
+            entry["hash"] = hash
+        with self._lock:
+            self.entries[relpath] = entry
+            if self._fp is None:
+                self._fp = open(self.path, "a")
+            self._fp.write(json.dumps(entry) + "\n")
+
+    def save(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(temp_path, self.path)
+
+
+class StageStats:
+    """
+    Wall times and resulting byte counts for the stages of processing one image.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.bytes = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + time.perf_counter() - start
+
+
+def recompress_external(args, input_path, output_path, stats: StageStats) -> bool:
+    """
+    Recompress with the graphicsmagick -> jpeg-recompress -> jpegoptim chain.
+    Returns whether the image was resized.
+    """
+    with stats.stage("probe"), Image.open(input_path) as img:
+        width, height = img.size
+
+    with stats.stage("resize"):
         if width > args.max_size or height > args.max_size:
             subprocess.check_call(
                 [
@@ -46,7 +278,9 @@ def process_image(args, relpath):
         else:
             shutil.copy(input_path, output_path)
             resized = False
+    stats.bytes["resize"] = os.stat(output_path).st_size
 
+    with stats.stage("recompress"):
         subprocess.check_call(
             [
                 "jpeg-recompress",
@@ -55,6 +289,9 @@ def process_image(args, relpath):
                 output_path,
             ],
         )
+    stats.bytes["recompress"] = os.stat(output_path).st_size
+
+    with stats.stage("optimize"):
         subprocess.check_call(
             [
                 "jpegoptim",
@@ -64,6 +301,214 @@ def process_image(args, relpath):
                 output_path,
             ],
         )
+    stats.bytes["optimize"] = os.stat(output_path).st_size
+    return resized
+
+
+def get_psnr(reference: Image.Image, candidate: Image.Image) -> float:
+    """
+    Get the PSNR between two grayscale images
+    (jpeg-recompress also compares luma only).
+    """
+    rms = ImageStat.Stat(ImageChops.difference(reference, candidate)).rms[0]
+    if rms == 0:
+        return math.inf
+    return 20 * math.log10(255 / rms)
+
+
+def encode_jpeg(img: Image.Image, **kwargs) -> bytes:
+    bio = io.BytesIO()
+    # Not passing `exif` or `icc_profile` strips all metadata, like `jpegoptim --strip-all`.
+    img.save(bio, format="JPEG", **kwargs)
+    return bio.getvalue()
+
+
+def find_jpeg_quality(args, img: Image.Image) -> int:
+    """
+    Bisect for the lowest JPEG quality that reaches the target PSNR.
+
+    The quality range and loop count default to jpeg-recompress's, but it uses
+    SSIM by default, and the target PSNR isn't calibrated against it, so the
+    resulting sizes are only roughly comparable to the external engine's.
+    """
+    reference = img.convert("L")
+    min_quality = args.min_quality
+    max_quality = args.max_quality
+    for _ in range(args.quality_loops):
+        quality = (min_quality + max_quality) // 2
+        with Image.open(io.BytesIO(encode_jpeg(img, quality=quality))) as probe:
+            psnr = get_psnr(reference, probe.convert("L"))
+        if psnr >= args.target_psnr:
+            max_quality = quality
+        else:
+            min_quality = quality
+        if max_quality - min_quality <= 1:
+            break
+    return max_quality
+
+
+def decode_and_resize(args, img: Image.Image, stats: StageStats) -> bool:
+    """
+    Decode `img` (in place), downscaling it to fit `--max-size`.
+    Returns whether the image was resized.
+    """
+    max_size = (args.max_size, args.max_size)
+    resized = img.width > args.max_size or img.height > args.max_size
+    with stats.stage("decode"):
+        if resized and img.format == "JPEG":
+            # Let libjpeg do most of the downscaling via DCT scaling while decoding;
+            # `draft` never goes below the requested size, so `thumbnail` finishes the job.
+            img.draft("RGB", max_size)
+        img.load()
+    if resized:
+        with stats.stage("resize"):
+            img.thumbnail(max_size, Image.LANCZOS)
+    return resized
+
+
+def write_output(input_path, output_path, data: bytes, *, keep_source: bool, stats):
+    with stats.stage("write"):
+        if keep_source and len(data) >= os.stat(input_path).st_size:
+            # Like jpeg-recompress, don't make things worse.
+            shutil.copy(input_path, output_path)
+        else:
+            with open(output_path, "wb") as f:
+                f.write(data)
+
+
+def recompress_pillow(args, input_path, output_path, stats: StageStats) -> bool:
+    """
+    Recompress in-process with Pillow, decoding the source only once.
+    Returns whether the image was resized.
+    """
+    with Image.open(input_path) as img:
+        if img.format != "JPEG":
+            return optimize_png(args, input_path, output_path, stats)
+        resized = decode_and_resize(args, img, stats)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        with stats.stage("search"):
+            quality = find_jpeg_quality(args, img)
+        with stats.stage("encode"):
+            data = encode_jpeg(img, quality=quality, optimize=True, progressive=True)
+        stats.bytes["encode"] = len(data)
+    write_output(input_path, output_path, data, keep_source=not resized, stats=stats)
+    return resized
+
+
+def optimize_png(args, input_path, output_path, stats: StageStats) -> bool:
+    """
+    Losslessly optimize (and possibly resize) a PNG in-process.
+    Returns whether the image was resized.
+    """
+    with Image.open(input_path) as img:
+        resized = decode_and_resize(args, img, stats)
+        with stats.stage("encode"):
+            bio = io.BytesIO()
+            img.save(bio, format="PNG", optimize=True)
+            data = bio.getvalue()
+        stats.bytes["encode"] = len(data)
+    write_output(input_path, output_path, data, keep_source=not resized, stats=stats)
+    return resized
+
+
+def convert_pillow(args, input_path, output_path, stats: StageStats) -> bool:
+    """
+    Convert an image to `--output-format` in-process.
+    Returns whether the image was resized.
+    """
+    output_format = args.output_format
+    with Image.open(input_path) as img:
+        resized = decode_and_resize(args, img, stats)
+        if img.mode not in ("RGB", "RGBA", "L", "LA"):
+            has_alpha = "A" in img.getbands() or "transparency" in img.info
+            img = img.convert("RGBA" if has_alpha else "RGB")
+        with stats.stage("encode"):
+            bio = io.BytesIO()
+            img.save(
+                bio,
+                format=output_format.upper(),
+                quality=get_output_quality(args),
+                **OUTPUT_FORMAT_OPTIONS[output_format],
+            )
+            data = bio.getvalue()
+        stats.bytes["encode"] = len(data)
+    write_output(input_path, output_path, data, keep_source=False, stats=stats)
+    return resized
+
+
+ENGINES = {
+    "external": recompress_external,
+    "pillow": recompress_pillow,
+}
+
+OUTPUT_FORMAT_OPTIONS = {
+    "webp": {"method": 6},
+    "avif": {"speed": 6},
+}
+OUTPUT_FORMAT_DEFAULT_QUALITY = {
+    "webp": 80,
+    "avif": 60,
+}
+
+
+def get_output_quality(args) -> int:
+    return args.output_quality or OUTPUT_FORMAT_DEFAULT_QUALITY[args.output_format]
+
+
+def get_output_relpath(args, relpath):
+    if args.output_format == "keep":
+        return relpath
+    return os.path.splitext(relpath)[0] + "." + args.output_format
+
+
+def check_output_names(args, relpaths):
+    """
+    Pass `relpaths` through, raising `ValueError` if two of them
+    would be written to the same output (e.g. `x.jpg` and `x.png` to `x.webp`).
+    """
+    seen = {}
+    for relpath in relpaths:
+        output_relpath = get_output_relpath(args, relpath)
+        other = seen.setdefault(output_relpath, relpath)
+        if other != relpath:
+            raise ValueError(
+                f"{other} and {relpath} would both be written to {output_relpath}",
+            )
+        yield relpath
+
+
+def get_pipeline(args, relpath):
+    """
+    Get the pipeline function and the resulting format for a source image.
+    """
+    if args.output_format != "keep":
+        return convert_pillow, args.output_format
+    if os.path.splitext(relpath)[-1].lower() == ".png":
+        # jpeg-recompress and jpegoptim can't do anything for PNGs
+        return optimize_png, "png"
+    return ENGINES[args.engine], "jpeg"
+
+
+def process_image(args, relpath):
+    start = time.perf_counter()
+    output_relpath = get_output_relpath(args, relpath)
+    input_path = os.path.join(args.input_directory, relpath)
+    output_path = os.path.join(args.output_directory, output_relpath)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    orig_stat = os.stat(input_path)
+    orig_size = orig_stat.st_size
+    resized = False
+    stats = StageStats()
+    pipeline, output_format = get_pipeline(args, relpath)
+
+    # With a manifest, `main` has already decided this image needs (re)doing.
+    if args.manifest or not os.path.exists(output_path):
+        if os.path.lexists(output_path):
+            # Don't write through a hardlink made by deduplication
+            os.unlink(output_path)
+        resized = pipeline(args, input_path, output_path, stats)
 
     new_size = os.stat(output_path).st_size
 
@@ -72,49 +517,548 @@ def process_image(args, relpath):
         shutil.copy(input_path, output_path)
         resized = False
 
-    return {
+    result = {
         "name": relpath,
+        "output_name": output_relpath,
+        "engine": args.engine,
+        "format": output_format,
         "resized": resized,
         "orig_size": orig_size,
+        "orig_mtime_ns": orig_stat.st_mtime_ns,
         "new_size": new_size,
+        "saved": orig_size - new_size,
         "ratio": (new_size / orig_size),
+        "stage_times": stats.times,
+        "stage_bytes": stats.bytes,
     }
+    if args.manifest and args.hash_sources and not args.dedup:
+        with stats.stage("hash"):
+            result["orig_hash"] = hash_file(input_path)
+    result["time"] = time.perf_counter() - start
+    result["finished_at"] = time.time()
+    return result
+
+
+def process_chunk(args, relpaths):
+    start = time.perf_counter()
+    results = [process_image(args, relpath) for relpath in relpaths]
+    return results, time.perf_counter() - start
+
+
+def run_pool(args, files):
+    """
+    Process `files` on the configured executor, yielding results as they complete.
+
+    At most `args.window` chunks are in flight at a time, and unless a fixed
+    `args.chunksize` is given, the chunk size is adapted to the observed
+    per-image processing time (so cheap up-to-date checks get batched,
+    but expensive images are handed out one by one).
+    """
+    chunksize = args.chunksize or 1
+    window = args.window or args.jobs * 4
+    files = iter(files)
+    pending = set()
+    with EXECUTORS[args.executor](max_workers=args.jobs) as executor:
+        while True:
+            while len(pending) < window and (
+                chunk := list(itertools.islice(files, chunksize))
+            ):
+                pending.add(executor.submit(process_chunk, args, chunk))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results, duration = future.result()
+                if not args.chunksize:
+                    per_image = duration / len(results)
+                    chunksize = max(
+                        1,
+                        min(
+                            MAX_AUTO_CHUNKSIZE,
+                            int(AUTO_CHUNK_SECONDS / max(per_image, 1e-6)),
+                        ),
+                    )
+                yield from results
+
+
+def iter_hashed(args, files):
+    """
+    Hash source files on a thread pool (hashlib releases the GIL while hashing),
+    yielding `(relpath, digest)` pairs as they complete, with bounded read-ahead.
+    """
+
+    def hash_one(relpath):
+        return relpath, hash_file(os.path.join(args.input_directory, relpath))
+
+    files = iter(files)
+    pending = set()
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        while True:
+            while len(pending) < args.jobs * 4 and (relpath := next(files, None)):
+                pending.add(executor.submit(hash_one, relpath))
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def link_output(src, dst, method: str):
+    """
+    Make `dst` a hardlink, reflink or copy of `src`,
+    falling back to copying if linking isn't possible.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        if method == "hardlink":
+            os.link(src, dst)
+            return method
+        if method == "reflink" and hasattr(fcntl, "FICLONE"):
+            with open(src, "rb") as src_fp, open(dst, "wb") as dst_fp:
+                fcntl.ioctl(dst_fp.fileno(), fcntl.FICLONE, src_fp.fileno())
+            return method
+    except OSError:  # e.g. cross-device, or the filesystem doesn't support it
+        if os.path.lexists(dst):
+            os.unlink(dst)
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+class Deduplicator:
+    """
+    Lets only the first source with a given content through to processing;
+    once that's been processed, its duplicates' outputs are linked to its output.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.digests = {}  # relpath -> digest
+        self.primaries = {}  # digest -> relpath
+        self.done = {}  # digest -> result
+        self.waiting = collections.defaultdict(list)  # digest -> [relpath]
+        self.ready = []
+
+    def filter(self, files):
+        for relpath, digest in iter_hashed(self.args, files):
+            self.digests[relpath] = digest
+            if digest in self.done:
+                self.ready.append(self.link(relpath, self.done[digest]))
+            elif digest in self.primaries:
+                self.waiting[digest].append(relpath)
+            else:
+                self.primaries[digest] = relpath
+                yield relpath
+
+    def on_result(self, result):
+        digest = self.digests[result["name"]]
+        self.done[digest] = result
+        for relpath in self.waiting.pop(digest, ()):
+            self.ready.append(self.link(relpath, result))
+
+    def pop_ready(self):
+        ready, self.ready = self.ready, []
+        return ready
+
+    def link(self, relpath, primary_result):
+        start = time.perf_counter()
+        input_path = os.path.join(self.args.input_directory, relpath)
+        output_relpath = get_output_relpath(self.args, relpath)
+        output_path = os.path.join(self.args.output_directory, output_relpath)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        orig_stat = os.stat(input_path)
+        method = link_output(
+            os.path.join(self.args.output_directory, primary_result["output_name"]),
+            output_path,
+            self.args.dedup,
+        )
+        duration = time.perf_counter() - start
+        new_size = primary_result["new_size"]
+        return {
+            "name": relpath,
+            "output_name": output_relpath,
+            "engine": primary_result["engine"],
+            "format": primary_result["format"],
+            "resized": primary_result["resized"],
+            "orig_size": orig_stat.st_size,
+            "orig_mtime_ns": orig_stat.st_mtime_ns,
+            "new_size": new_size,
+            "saved": orig_stat.st_size - new_size,
+            "ratio": (new_size / orig_stat.st_size),
+            "dedup_of": primary_result["name"],
+            "dedup_method": method,
+            "stage_times": {"link": duration},
+            "stage_bytes": {},
+            "time": duration,
+            "finished_at": time.time(),
+        }
 
 
-def get_images(input_directory):
-    files = []
-    image_formats = {".jpg", ".jpeg", ".png"}
-    for dirname, dirnames, filenames in os.walk(input_directory):
-        for f in filenames:
-            f = os.path.join(dirname, f)
-            ext = os.path.splitext(f)[-1].lower()
-            if ext not in image_formats:
-                continue
-            files.append(os.path.relpath(f, input_directory))
-    files.sort()
+def iter_images(input_directory, *, sort=False, _reldir=""):
+    """
+    Yield relative paths of images in `input_directory`.
+
+    With `sort`, each directory's entries are sorted, which makes
+    the overall order the same as sorting all of the relative paths.
+    """
+    try:
+        with os.scandir(os.path.join(input_directory, _reldir)) as it:
+            entries = [
+                (entry.name, entry.is_dir(follow_symlinks=False)) for entry in it
+            ]
+    except OSError as exc:
+        # Skip unreadable directories, like `os.walk` does
+        print(f"Skipping {exc.filename}: {exc.strerror}", file=sys.stderr)
+        return
+    if sort:
+        # Sort directories as if with a trailing separator, like their contents would be.
+        entries.sort(key=lambda e: e[0] + os.sep if e[1] else e[0])
+    for name, is_dir in entries:
+        relpath = os.path.join(_reldir, name) if _reldir else name
+        if is_dir:
+            yield from iter_images(input_directory, sort=sort, _reldir=relpath)
+        elif os.path.splitext(name)[-1].lower() in IMAGE_FORMATS:
+            yield relpath
+
+
+def get_images(input_directory, *, sort=False):
+    files = list(iter_images(input_directory))
+    if sort:
+        files.sort()
     return files
 
 
+class ImageDiscoverer(threading.Thread):
+    """
+    Consumes `files` (e.g. a lazy `iter_images` walk) in the background,
+    feeding images that pass `accept` to a bounded queue that can be iterated over.
+    """
+
+    _done = object()
+
+    def __init__(self, files, *, accept=None, maxsize=10000):
+        super().__init__(daemon=True)
+        self.files = files
+        self.accept = accept
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.n_found = 0
+        self.n_queued = 0
+        self.error = None
+
+    def run(self):
+        try:
+            for relpath in self.files:
+                self.n_found += 1
+                if self.accept and not self.accept(relpath):
+                    continue
+                self.n_queued += 1
+                self.queue.put(relpath)
+        except BaseException as exc:
+            self.error = exc
+        finally:
+            self.queue.put(self._done)
+
+    def __iter__(self):
+        while (relpath := self.queue.get()) is not self._done:
+            yield relpath
+        if self.error:
+            raise self.error
+
+
+def percentile(sorted_values, p: float):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return math.nan
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def read_logs(log_paths):
+    for log_path in log_paths:
+        with open(log_path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def report(results, *, n_slowest=10):
+    n = 0
+    n_dedup = 0
+    orig_bytes = 0
+    new_bytes = 0
+    first_start = math.inf
+    last_finish = -math.inf
+    stage_times = {}
+    slowest = []
+    for result in results:
+        n += 1
+        orig_bytes += result["orig_size"]
+        new_bytes += result["new_size"]
+        n_dedup += "dedup_of" in result
+        for stage, duration in result.get("stage_times", {}).items():
+            stage_times.setdefault(stage, []).append(duration)
+        if "time" in result:
+            if len(slowest) < n_slowest:
+                heapq.heappush(slowest, (result["time"], result["name"]))
+            else:
+                heapq.heappushpop(slowest, (result["time"], result["name"]))
+            if "finished_at" in result:
+                first_start = min(first_start, result["finished_at"] - result["time"])
+                last_finish = max(last_finish, result["finished_at"])
+
+    if not n:
+        print("No results.")
+        return
+    saved = orig_bytes - new_bytes
+    print(f"Images:      {n}")
+    if n_dedup:
+        print(f"Deduped:     {n_dedup}")
+    print(f"Input:       {orig_bytes / 1e6:.1f} MB")
+    print(f"Output:      {new_bytes / 1e6:.1f} MB")
+    print(f"Saved:       {saved / 1e6:.1f} MB ({saved / orig_bytes:.1%})")
+    if last_finish > first_start:
+        # Only meaningful for a single run (or back-to-back runs).
+        wall = last_finish - first_start
+        print(f"Wall time:   {wall:.1f} s")
+        print(
+            f"Throughput:  {n / wall:.2f} images/s, {orig_bytes / 1e6 / wall:.2f} MB/s",
+        )
+    if stage_times:
+        print()
+        print("Stage      |      n |  p50 (s) |  p95 (s) |  p99 (s) | total (s)")
+        for stage, durations in stage_times.items():
+            durations.sort()
+            print(
+                f"{stage:10} | {len(durations):6d} | "
+                f"{percentile(durations, 50):8.3f} | "
+                f"{percentile(durations, 95):8.3f} | "
+                f"{percentile(durations, 99):8.3f} | "
+                f"{sum(durations):9.1f}",
+            )
+    if slowest:
+        print()
+        print("Slowest images:")
+        for duration, name in sorted(slowest, reverse=True):
+            print(f"{duration:8.3f} s  {name}")
+
+
+def report_main(argv):
+    ap = argparse.ArgumentParser(prog=f"{os.path.basename(sys.argv[0])} report")
+    ap.add_argument("log_files", nargs="+", metavar="LOG_FILE")
+    ap.add_argument("--slowest", default=10, type=int)
+    args = ap.parse_args(argv)
+    report(read_logs(args.log_files), n_slowest=args.slowest)
+
+
 def main():
-    ap = argparse.ArgumentParser()
+    if sys.argv[1:2] == ["report"]:
+        return report_main(sys.argv[2:])
+    ap = argparse.ArgumentParser(
+        epilog="Use `report LOG_FILE...` to summarize previous runs' logs.",
+    )
     ap.add_argument("input_directory")
     ap.add_argument("output_directory")
     ap.add_argument("--max-size", default=2000, type=int)
     ap.add_argument("--log-file", default=None)
+    ap.add_argument(
+        "--engine",
+        choices=sorted(ENGINES),
+        default="external",
+        help="external: gm/jpeg-recompress/jpegoptim; pillow: in-process",
+    )
+    ap.add_argument(
+        "--target-psnr",
+        default=36.0,
+        type=float,
+        help="Target luma PSNR for the pillow engine's quality search "
+        "(an approximation; not calibrated against jpeg-recompress's SSIM target)",
+    )
+    ap.add_argument("--min-quality", default=40, type=int)
+    ap.add_argument("--max-quality", default=95, type=int)
+    ap.add_argument("--quality-loops", default=6, type=int)
+    ap.add_argument(
+        "--output-format",
+        choices=("keep", *OUTPUT_FORMAT_OPTIONS),
+        default="keep",
+        help="Convert images to this format (rewriting extensions) instead of recompressing",
+    )
+    ap.add_argument(
+        "--output-quality",
+        default=None,
+        type=int,
+        help=f"Quality for --output-format (default: {OUTPUT_FORMAT_DEFAULT_QUALITY})",
+    )
+    ap.add_argument(
+        "--stream",
+        action="store_true",
+        help="Start processing while the input directory is still being scanned",
+    )
+    ap.add_argument(
+        "--sort",
+        action="store_true",
+        help="Process images in sorted order",
+    )
+    ap.add_argument(
+        "--dedup",
+        choices=("hardlink", "reflink", "copy"),
+        default=None,
+        help="Process byte-identical sources only once, and link or copy their outputs",
+    )
+    ap.add_argument(
+        "--executor",
+        choices=sorted(EXECUTORS),
+        default="thread",
+        help="Use processes when CPU-bound Python work (e.g. --engine=pillow) dominates",
+    )
+    ap.add_argument("-j", "--jobs", default=os.cpu_count(), type=int)
+    ap.add_argument(
+        "--chunksize",
+        default=0,
+        type=int,
+        help="Images per task (default: adapt to processing time)",
+    )
+    ap.add_argument(
+        "--window",
+        default=0,
+        type=int,
+        help="Maximum number of chunks in flight (default: 4 * jobs)",
+    )
+    ap.add_argument(
+        "--manifest",
+        default=None,
+        help=f"Manifest file for incremental runs (default: OUTPUT_DIRECTORY/{MANIFEST_NAME})",
+    )
+    ap.add_argument(
+        "--no-manifest",
+        dest="manifest",
+        action="store_false",
+        help="Don't use a manifest; skip any image whose output exists",
+    )
+    ap.add_argument(
+        "--hash-sources",
+        action="store_true",
+        help="Also record source hashes, so touched-but-unchanged sources aren't redone",
+    )
+    ap.add_argument(
+        "--seed-manifest",
+        metavar="LOG_FILE",
+        action="append",
+        default=[],
+        help="Seed the manifest from a previous run's log (assumes the same settings)",
+    )
+    ap.add_argument(
+        "--adopt-existing",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="Treat existing outputs without a manifest entry as up to date "
+        "(default: only if not seeding; never for sources a seed log rejects)",
+    )
     args = ap.parse_args()
     args.log_file = args.log_file or "recompress-log-%s.jsonl" % time.time()
-    files = get_images(args.input_directory)
-    pool = mp.Pool()
-
-    with open(args.log_file, "w") as logfp:
-        print("Logging to:", logfp.name)
-        mapper = pool.imap_unordered(
-            functools.partial(process_image, args),
-            files,
-            chunksize=32,
+    if args.manifest is None:
+        args.manifest = os.path.join(args.output_directory, MANIFEST_NAME)
+    if args.output_format != "keep":
+        Image.init()
+        if args.output_format.upper() not in Image.SAVE:
+            ap.error(f"This Pillow installation can't write {args.output_format}")
+
+    manifest = None
+    accept = None
+    if args.manifest:
+        os.makedirs(os.path.dirname(os.path.abspath(args.manifest)), exist_ok=True)
+        manifest = Manifest(
+            args.manifest,
+            params=get_pipeline_params(args),
+            use_hash=args.hash_sources,
+            adopt_existing=(
+                args.adopt_existing
+                if args.adopt_existing is not None
+                else not args.seed_manifest
+            ),
+        ).load()
+        for log_path in args.seed_manifest:
+            n = manifest.seed_from_log(
+                log_path,
+                args.input_directory,
+                args.output_directory,
+            )
+            print(f"Seeded {n} manifest entries from {log_path}")
+
+        def accept(relpath):
+            return not manifest.is_current(
+                relpath,
+                os.path.join(args.input_directory, relpath),
+                os.path.join(args.output_directory, get_output_relpath(args, relpath)),
+            )
+
+    discoverer = None
+    if args.stream:
+        discoverer = ImageDiscoverer(
+            check_output_names(
+                args,
+                iter_images(args.input_directory, sort=args.sort),
+            ),
+            accept=accept,
+            maxsize=max(1000, args.jobs * 64),
         )
-        for result in tqdm.tqdm(mapper, total=len(files)):
-            logfp.write(json.dumps(result) + "\n")
+        discoverer.start()
+        files = discoverer
+        total = None
+    else:
+        files = get_images(args.input_directory, sort=args.sort)
+        try:
+            collections.deque(check_output_names(args, files), maxlen=0)
+        except ValueError as exc:
+            ap.error(str(exc))
+        n_total = len(files)
+        if accept:
+            files = [relpath for relpath in files if accept(relpath)]
+            print(f"{n_total - len(files)} of {n_total} images are up to date")
+        total = len(files)
+
+    dedup = None
+    if args.dedup:
+        dedup = Deduplicator(args)
+        files = dedup.filter(files)
+
+    try:
+        with open(args.log_file, "w") as logfp, tqdm.tqdm(total=total) as progress:
+            print("Logging to:", logfp.name)
+
+            def handle_result(result):
+                logfp.write(json.dumps(result) + "\n")
+                if manifest:
+                    manifest.record(
+                        result["name"],
+                        size=result["orig_size"],
+                        mtime_ns=result["orig_mtime_ns"],
+                        hash=result.get("orig_hash")
+                        or (dedup and dedup.digests.get(result["name"])),
+                    )
+                if discoverer:
+                    # Grow the total as images are discovered
+                    progress.total = discoverer.n_queued
+                progress.update()
+
+            for result in run_pool(args, files):
+                handle_result(result)
+                if dedup:
+                    dedup.on_result(result)
+                    for dup_result in dedup.pop_ready():
+                        handle_result(dup_result)
+            if dedup:
+                for dup_result in dedup.pop_ready():
+                    handle_result(dup_result)
+    finally:
+        if manifest:
+            manifest.save()
+    if discoverer and manifest:
+        n_total = discoverer.n_found
+        n_done = discoverer.n_queued
+        print(f"{n_total - n_done} of {n_total} images were up to date")
+    if manifest and manifest.n_adopted:
+        print(f"Adopted {manifest.n_adopted} existing outputs into the manifest")
 
 
 if __name__ == "__main__":
@@ -1,8 +1,23 @@
 from __future__ import annotations
 
 import argparse
+import collections
+import contextlib
 import dataclasses
+import hashlib
+import json
+import os
+import queue
+import re
+import shutil
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+hunk_header_re = re.compile(r"^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@")
+notebook_cell_re = re.compile(r":cell \d+$")
+# Bumped to invalidate cached results from older versions of this script
+CACHE_VERSION = 2
 
 
 @dataclasses.dataclass(frozen=True)
@@ -18,13 +33,17 @@ class TestResult:
         return self.added + self.deleted
 
 
-def check_width(target, width: int) -> TestResult:
-    subprocess.check_call(["git", "restore", target])
-    subprocess.check_call(["ruff", "format", "-q", f"--line-length={width}", target])
+def check_width(target, width: int, cwd=None) -> TestResult:
+    subprocess.check_call(["git", "restore", target], cwd=cwd)
+    subprocess.check_call(
+        ["ruff", "format", "-q", f"--line-length={width}", target],
+        cwd=cwd,
+    )
     files = {}
     for line in subprocess.check_output(
         ["git", "diff", "--numstat", target],
         text=True,
+        cwd=cwd,
     ).splitlines():
         line = line.strip()
         if not line:
@@ -40,33 +59,400 @@ def check_width(target, width: int) -> TestResult:
     )
 
 
+def parse_unified_diff(diff: str) -> dict[str, tuple[int, int]]:
+    """
+    Count added and deleted lines per file in a unified diff.
+    Hunk line counts are tracked, so content lines looking like headers don't confuse this.
+    """
+    files = {}
+    file = None
+    old_left = new_left = 0
+    for line in diff.splitlines():
+        if old_left or new_left:
+            added, deleted = files[file]
+            if line.startswith("+"):
+                files[file] = (added + 1, deleted)
+                new_left -= 1
+            elif line.startswith("-"):
+                files[file] = (added, deleted + 1)
+                old_left -= 1
+            elif not line.startswith("\\"):  # "\ No newline at end of file"
+                old_left -= 1
+                new_left -= 1
+        elif line.startswith("+++ "):
+            # Notebooks are diffed per cell, e.g. "+++ nb.ipynb:cell 3"
+            file = notebook_cell_re.sub("", line[4:].split("\t")[0])
+            files.setdefault(file, (0, 0))
+        elif m := hunk_header_re.match(line):
+            old_left = int(m.group(1) or 1)
+            new_left = int(m.group(2) or 1)
+    return files
+
+
+def check_width_in_memory(targets: list[str], width: int) -> TestResult:
+    """
+    Measure the changes formatting at `width` would make using `ruff format --diff`,
+    without writing anything.
+    """
+    files = {}
+    # Batched, so long lists of files don't overflow the command line
+    for i in range(0, len(targets), 500):
+        proc = subprocess.run(
+            [
+                "ruff",
+                "format",
+                "-q",
+                "--diff",
+                "--force-exclude",
+                f"--line-length={width}",
+                *targets[i : i + 500],
+            ],
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        if proc.returncode not in (0, 1):  # 1 means "would reformat"
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        for file, counts in parse_unified_diff(proc.stdout).items():
+            if counts != (0, 0):
+                files[file] = counts
+    return TestResult(
+        width=width,
+        added=sum(added for added, _ in files.values()),
+        deleted=sum(deleted for _, deleted in files.values()),
+        changed_files=len(files),
+        files=files,
+    )
+
+
+@contextlib.contextmanager
+def temporary_worktrees(n: int):
+    """
+    Create `n` temporary detached git worktrees, yielding their paths.
+
+    The worktrees are checked out from the index (not HEAD), as that's what
+    the in-place mode formats and restores, staged changes included.
+    """
+    index_tree = subprocess.check_output(["git", "write-tree"], text=True).strip()
+    temp_dir = tempfile.mkdtemp(prefix="ruff-comfy-format-")
+    paths = []
+    try:
+        for i in range(n):
+            path = os.path.join(temp_dir, str(i))
+            subprocess.check_call(
+                ["git", "worktree", "add", "-q", "--detach", "--no-checkout", path],
+            )
+            paths.append(path)
+            subprocess.check_call(
+                ["git", "read-tree", "-u", "--reset", index_tree],
+                cwd=path,
+            )
+        yield paths
+    finally:
+        for path in paths:
+            subprocess.call(["git", "worktree", "remove", "--force", path])
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def check_widths_in_worktrees(
+    target,
+    widths,
+    worktree_paths: list[str],
+) -> dict[int, TestResult]:
+    """
+    Check widths in parallel, each worker formatting its own worktree,
+    so the working tree is never touched.
+    """
+    toplevel = subprocess.check_output(
+        ["git", "rev-parse", "--show-toplevel"],
+        text=True,
+    ).strip()
+    target_relpath = os.path.relpath(os.path.abspath(target), toplevel)
+    free_worktrees = queue.SimpleQueue()
+    for path in worktree_paths:
+        free_worktrees.put(path)
+
+    def check_in_worktree(width):
+        path = free_worktrees.get()
+        try:
+            return check_width(target_relpath, width, cwd=path)
+        finally:
+            free_worktrees.put(path)
+
+    with ThreadPoolExecutor(max_workers=len(worktree_paths)) as executor:
+        return {
+            result.width: result for result in executor.map(check_in_worktree, widths)
+        }
+
+
+def get_python_files(target) -> list[str]:
+    """
+    List the (tracked or untracked but not ignored) files in `target`
+    that ruff formats by default (Python files, stubs and notebooks).
+    """
+    output = subprocess.check_output(
+        [
+            "git",
+            "ls-files",
+            "--cached",
+            "--others",
+            "--exclude-standard",
+            "--",
+            *(
+                [f"{target}/*{suffix}" for suffix in (".py", ".pyi", ".ipynb")]
+                if os.path.isdir(target)
+                else [target]
+            ),
+        ],
+        text=True,
+    )
+    return sorted({line for line in output.splitlines() if os.path.isfile(line)})
+
+
+def find_ruff_config(target) -> str | None:
+    path = os.path.abspath(target)
+    while True:
+        for name in ("ruff.toml", ".ruff.toml", "pyproject.toml"):
+            config_path = os.path.join(path, name)
+            if os.path.isfile(config_path):
+                if name != "pyproject.toml" or "[tool.ruff" in read_text(config_path):
+                    return config_path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def read_text(path) -> str:
+    with open(path) as f:
+        return f.read()
+
+
+def hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of per-file results, keyed by the file's content hash, the ruff version
+    and configuration, and the width.
+    """
+
+    def __init__(self, path: str, *, target):
+        self.path = path
+        ruff_version = subprocess.check_output(["ruff", "--version"], text=True).strip()
+        config_path = find_ruff_config(target)
+        config_hash = hash_text(read_text(config_path)) if config_path else ""
+        self.prefix = f"{CACHE_VERSION}:{ruff_version}:{config_hash}"
+        self.entries = {}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        return self
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def get(self, content_hash: str, width: int) -> tuple[int, int] | None:
+        value = self.entries.get(f"{self.prefix}:{content_hash}:{width}")
+        return tuple(value) if value is not None else None
+
+    def put(self, content_hash: str, width: int, counts: tuple[int, int]):
+        self.entries[f"{self.prefix}:{content_hash}:{width}"] = list(counts)
+
+
+def check_width_cached(
+    file_hashes: dict[str, str],
+    width: int,
+    cache: ResultCache,
+) -> TestResult:
+    """
+    Like `check_width_in_memory`, but only format files with no cached result.
+    """
+    missing = [file for file, h in file_hashes.items() if cache.get(h, width) is None]
+    if missing:
+        result = check_width_in_memory(missing, width)
+        # ruff prints paths relative to the working directory, or absolute ones
+        # for files outside it, so they needn't match the `git ls-files` ones
+        counts_by_path = {
+            os.path.realpath(file): counts for file, counts in result.files.items()
+        }
+        for file in missing:
+            cache.put(
+                file_hashes[file],
+                width,
+                counts_by_path.get(os.path.realpath(file), (0, 0)),
+            )
+    files = {}
+    for file, h in file_hashes.items():
+        counts = cache.get(h, width)
+        if counts != (0, 0):
+            files[file] = counts
+    return TestResult(
+        width=width,
+        added=sum(added for added, _ in files.values()),
+        deleted=sum(deleted for _, deleted in files.values()),
+        changed_files=len(files),
+        files=files,
+    )
+
+
+def search_widths(widths: list[int], evaluate, *, step: int, top: int):
+    """
+    Evaluate every `step`th width, then all widths around the `top` best of those.
+    """
+    result_map = evaluate(widths[::step])
+    best = sorted(result_map.values(), key=lambda r: r.total_delta)[:top]
+    refine = set()
+    for result in best:
+        i = widths.index(result.width)
+        refine.update(widths[max(0, i - step + 1) : i + step])
+    result_map.update(evaluate(sorted(refine - set(result_map))))
+    return result_map
+
+
+def get_optimal_widths(result_map: dict[int, TestResult], key) -> dict[str, int]:
+    """
+    Find the width with the smallest total delta for each group of files
+    (as grouped by `key(file)`); ties go to the narrowest width.
+    """
+    deltas = collections.defaultdict(dict)
+    for width, result in result_map.items():
+        for file, (added, deleted) in result.files.items():
+            group = deltas[key(file)]
+            group[width] = group.get(width, 0) + added + deleted
+    return {
+        group: min(result_map, key=lambda w: (group_deltas.get(w, 0), w))
+        for group, group_deltas in deltas.items()
+    }
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--target", required=True)
     ap.add_argument("--min-width", type=int, default=72)
     ap.add_argument("--max-width", type=int, default=120)
+    ap.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=0,
+        help="Check widths in parallel in this many temporary git worktrees "
+        "(checked out from the index) instead of in place",
+    )
+    ap.add_argument(
+        "--in-memory",
+        action="store_true",
+        help="Measure with `ruff format --diff` without touching any files "
+        "(-j then just sets the parallelism)",
+    )
+    ap.add_argument(
+        "--cache",
+        default=None,
+        help="Cache per-file results in this file (implies --in-memory)",
+    )
+    ap.add_argument(
+        "--coarse-step",
+        type=int,
+        default=1,
+        help="Check every Nth width first, then refine around the best ones",
+    )
+    ap.add_argument(
+        "--refine-top",
+        type=int,
+        default=2,
+        help="Number of best coarse widths to refine around",
+    )
+    ap.add_argument(
+        "--report-files",
+        action="store_true",
+        help="Also report the optimal width for each directory and file",
+    )
     args = ap.parse_args()
 
-    widths = range(args.min_width, args.max_width + 1)
+    widths = [
+        width
+        for width in range(args.min_width, args.max_width + 1)
+        if width % 2 == 0 or width % 5 == 0
+    ]
     target = args.target
+    jobs = max(1, args.jobs)
 
-    if subprocess.call(["git", "diff", "--quiet", "--exit-code", target]) != 0:
+    if args.cache or args.in_memory:
+        cache = None
+        if args.cache:
+            cache = ResultCache(args.cache, target=target).load()
+            file_hashes = {
+                file: hash_text(read_text(file)) for file in get_python_files(target)
+            }
+
+        def check(width):
+            if cache:
+                return check_width_cached(file_hashes, width, cache)
+            return check_width_in_memory([target], width)
+
+        def evaluate(widths):
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                return {result.width: result for result in executor.map(check, widths)}
+
+        try:
+            result_map = run_search(args, widths, evaluate)
+        finally:
+            if cache:
+                cache.save()
+    elif subprocess.call(["git", "diff", "--quiet", "--exit-code", target]) != 0:
         ap.error("Target is not clean, refusing to work on it.")
+    elif args.jobs:
+        with temporary_worktrees(min(args.jobs, len(widths))) as worktree_paths:
+            result_map = run_search(
+                args,
+                widths,
+                lambda widths: check_widths_in_worktrees(
+                    target,
+                    widths,
+                    worktree_paths,
+                ),
+            )
+    else:
 
-    result_map = {}
+        def evaluate(widths):
+            return {width: check_width(target, width) for width in widths}
 
-    try:
-        for width in widths:
-            if not (width % 2 == 0 or width % 5 == 0):
-                continue
-            result_map[width] = check_width(target, width)
-    finally:
-        subprocess.check_call(["git", "restore", target])
+        try:
+            result_map = run_search(args, widths, evaluate)
+        finally:
+            subprocess.check_call(["git", "restore", target])
     results = sorted(result_map.values(), key=lambda r: r.total_delta)
     print("Rank | Width | Total Delta")
     for i, result in enumerate(results, 1):
         print(f"{i:4d} | {result.width:5d} | {result.total_delta:11d}")
 
+    if args.report_files:
+        for title, key in [
+            ("Directory", os.path.dirname),
+            ("File", lambda file: file),
+        ]:
+            print()
+            print(f"Width | {title}")
+            for group, width in sorted(get_optimal_widths(result_map, key).items()):
+                print(f"{width:5d} | {group or '.'}")
+
+
+def run_search(args, widths, evaluate):
+    if args.coarse_step > 1:
+        return search_widths(
+            widths,
+            evaluate,
+            step=args.coarse_step,
+            top=args.refine_top,
+        )
+    return evaluate(widths)
+
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,10 @@
+"""
+Chart (or enumerate) image resolution buckets around a target pixel count.
+"""
+
 import argparse
+import bisect
+import math
 from fractions import Fraction
 
 COMMON_ASPECT_RATIOS = [
@@ -11,43 +17,87 @@ COMMON_ASPECT_RATIOS = [
     Fraction(16, 9),
 ]
 COMMON_ASPECT_RATIOS.extend([ar**-1 for ar in COMMON_ASPECT_RATIOS])
+# Sorted, deduplicated copy of the above for bisection
+_SORTED_ASPECT_RATIOS = sorted(set(COMMON_ASPECT_RATIOS))
+
+# Native resolutions of various models, in megapixels
+MODEL_PRESETS = {
+    "sd15": 512 * 512 / (1024 * 1024),
+    "sd2": 768 * 768 / (1024 * 1024),
+    "sdxl": 1.0,
+}
 
 
-def get_nearest_ar(ar: Fraction):
-    return min(COMMON_ASPECT_RATIOS, key=lambda common_ar: abs(common_ar - ar))
+def get_nearest_ar(ar: Fraction) -> Fraction:
+    i = bisect.bisect_left(_SORTED_ASPECT_RATIOS, ar)
+    candidates = _SORTED_ASPECT_RATIOS[max(i - 1, 0) : i + 1]
+    # On ties, prefer the one listed first in `COMMON_ASPECT_RATIOS`
+    return min(
+        candidates,
+        key=lambda common_ar: (
+            abs(common_ar - ar),
+            COMMON_ASPECT_RATIOS.index(common_ar),
+        ),
+    )
 
 
 def quantize(n: int, q: int) -> int:
     return round(n / q) * q
 
 
+def get_buckets(
+    target_mpix: float = 1,
+    *,
+    pix_leeway: float = 0.1,
+    min_ar: float = 0.5,
+    max_ar: float = 2.0,
+    grid: int = 64,
+    max_size: int | None = None,
+) -> list[tuple[int, int]]:
+    """
+    Get the `(w, h)` sizes on a `grid`-pixel grid whose pixel count is within
+    `pix_leeway` of `target_mpix` megapixels and whose aspect ratio is within
+    `[min_ar, max_ar]`, sorted by aspect ratio (then size).
+    """
+    target_pix = target_mpix * 1024 * 1024
+    if max_size is None:
+        max_size = int(target_mpix * 1024 * 2)
+    min_pix = target_pix * (1 - pix_leeway)
+    max_pix = target_pix * (1 + pix_leeway)
+    # Sizes below `max_size`, rounded to the grid
+    largest = quantize(grid + (max_size - 1 - grid) // 8 * 8, grid)
+
+    buckets = []
+    for w in range(grid, largest + 1, grid):
+        # Solve for the grid-aligned `h` range within the pixel window
+        # (one step of slack either way for float rounding; checked below)
+        h_lo = max(grid, (math.ceil(min_pix / w / grid) - 1) * grid)
+        h_hi = min(largest, (math.floor(max_pix / w / grid) + 1) * grid)
+        for h in range(h_lo, h_hi + 1, grid):
+            if min_pix <= w * h <= max_pix and min_ar <= w / h <= max_ar:
+                buckets.append((w, h))
+    buckets.sort(key=lambda wh: (wh[0] / wh[1], wh[0]))
+    return buckets
+
+
 def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--target-mpix", default=1, type=float)
+    ap.add_argument("--preset", choices=sorted(MODEL_PRESETS))
+    ap.add_argument("--target-mpix", type=float, help="default 1, or per --preset")
     ap.add_argument("--pix-leeway", default=0.1, type=float)
     ap.add_argument("--min-ar", default=0.5, type=float)
     ap.add_argument("--max-ar", default=2.0, type=float)
     args = ap.parse_args()
-    target_pix = args.target_mpix * 1024 * 1024
-    max_size = int(args.target_mpix * 1024 * 2)
-    pix_leeway = args.pix_leeway
-    min_ar = args.min_ar
-    max_ar = args.max_ar
-    min_pix = target_pix * (1 - pix_leeway)
-    max_pix = target_pix * (1 + pix_leeway)
-
-    options = set()
-
-    for w in range(64, max_size, 8):
-        for h in range(64, max_size, 8):
-            w = quantize(w, 64)
-            h = quantize(h, 64)
-            pix = w * h
-            ar = w / h
-            if min_pix <= pix <= max_pix and min_ar <= ar <= max_ar:
-                options.add((w, h))
+    target_mpix = args.target_mpix
+    if target_mpix is None:
+        target_mpix = MODEL_PRESETS[args.preset] if args.preset else 1
 
-    for w, h in sorted(options, key=lambda wh: wh[0] / wh[1]):
+    for w, h in get_buckets(
+        target_mpix,
+        pix_leeway=args.pix_leeway,
+        min_ar=args.min_ar,
+        max_ar=args.max_ar,
+    ):
         pix = w * h
         ar = Fraction(w, h)
         nearest_common_ar = get_nearest_ar(ar)
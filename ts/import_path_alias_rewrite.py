@@ -1,39 +1,396 @@
 import argparse
 import dataclasses
 import difflib
+import fnmatch
+import json
+import os
 import pathlib
 import re
-from functools import partial
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache, cached_property, partial
 
 from_comp_re = re.compile(r" from '(.+)';$", re.MULTILINE)
 
+# Fewer files than this are processed without a process pool
+SERIAL_THRESHOLD = 64
+
+DEFAULT_EXCLUDES = [
+    ".git",
+    ".next",
+    ".turbo",
+    "build",
+    "coverage",
+    "dist",
+    "node_modules",
+]
+
 
 @dataclasses.dataclass(frozen=True)
 class Context:
     root_path: pathlib.Path
     accepted_segments: list[str]
+    # Alias target directory (resolved, as a string) -> alias prefix, e.g. "@/"
+    aliases: dict[str, str] = dataclasses.field(default_factory=dict)
+    # Patch paths are relative to this (the git toplevel, if any), or `root_path`
+    patch_root: pathlib.Path | None = None
+
+    @cached_property
+    def accepted_segments_re(self) -> re.Pattern:
+        return re.compile("|".join(re.escape(seg) for seg in self.accepted_segments))
 
     def is_acceptable(self, at_path: str):
         if not self.accepted_segments:
             return True
-        return any(seg in at_path for seg in self.accepted_segments)
+        return bool(self.accepted_segments_re.search(at_path))
+
+    def get_aliased(self, path: pathlib.Path) -> str | None:
+        """
+        Get the aliased specifier for `path`, using the longest matching alias target.
+
+        An alias target directory itself can't be expressed with its own alias
+        (`@/*` doesn't match `@`), only with a shorter one, if any.
+        """
+        # Walking up the parents is a longest-prefix lookup over path components.
+        for target in (path, *path.parents):
+            alias = self.aliases.get(str(target))
+            if alias is not None and target != path:
+                return f"{alias}{path.relative_to(target).as_posix()}"
+        return None
+
+    def is_alias_target(self, path: pathlib.Path) -> bool:
+        return str(path) in self.aliases
+
+
+def strip_jsonc(text: str) -> str:
+    """Strip comments and trailing commas from JSONC (as used by tsconfig.json)."""
+    string_re = r'("(?:\\.|[^"\\])*")'
+    text = re.sub(
+        rf"{string_re}|//[^\n]*|/\*.*?\*/",
+        lambda m: m.group(1) or "",
+        text,
+        flags=re.DOTALL,
+    )
+    return re.sub(rf"{string_re}|,(?=\s*[}}\]])", lambda m: m.group(1) or "", text)
+
+
+def read_tsconfig_aliases(tsconfig_path: pathlib.Path) -> dict[str, str]:
+    """
+    Read wildcard `compilerOptions.paths` aliases (e.g. `"@/*": ["./src/*"]`)
+    from a tsconfig.json. (`extends` is not followed.)
+    """
+    options = json.loads(strip_jsonc(tsconfig_path.read_text())).get(
+        "compilerOptions",
+        {},
+    )
+    base_path = (tsconfig_path.parent / options.get("baseUrl", ".")).resolve()
+    aliases = {}
+    for pattern, targets in options.get("paths", {}).items():
+        if not pattern.endswith("*"):
+            continue
+        for target in targets:
+            if target.endswith("*"):
+                target_dir = (base_path / target[:-1]).resolve()
+                # The first pattern mapping to a directory wins
+                aliases.setdefault(str(target_dir), pattern[:-1])
+    return aliases
+
+
+@dataclasses.dataclass(frozen=True)
+class IgnoreRule:
+    base: str  # directory (relative to the root) the rule applies under
+    regex: re.Pattern
+    negated: bool
+    dir_only: bool
+
+    def matches(self, relpath: str, is_dir: bool) -> bool:
+        if self.dir_only and not is_dir:
+            return False
+        if self.base:
+            if not relpath.startswith(self.base + "/"):
+                return False
+            relpath = relpath[len(self.base) + 1 :]
+        return bool(self.regex.match(relpath))
+
+
+def gitignore_pattern_to_regex(pattern: str, *, anchored: bool) -> re.Pattern:
+    bits = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            bits.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            bits.append("(?:/.*)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            bits.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            bits.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            bits.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and (end := pattern.find("]", i + 1)) > i:
+            bits.append(pattern[i : end + 1])
+            i = end + 1
+        else:
+            bits.append(re.escape(pattern[i]))
+            i += 1
+    prefix = "" if anchored else "(?:.*/)?"
+    return re.compile(f"^{prefix}{''.join(bits)}$")
+
+
+def read_gitignore(path: pathlib.Path, base: str) -> list[IgnoreRule]:
+    """
+    Read (a reasonable subset of) gitignore rules from `path`;
+    `base` is the relative directory the file is in.
+    """
+    rules = []
+    for line in path.read_text().splitlines():
+        line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        # A slash anywhere but the end anchors the pattern to the .gitignore's directory
+        anchored = "/" in line
+        line = line.lstrip("/")
+        rules.append(
+            IgnoreRule(
+                base=base,
+                regex=gitignore_pattern_to_regex(line, anchored=anchored),
+                negated=negated,
+                dir_only=dir_only,
+            ),
+        )
+    return rules
+
+
+def is_ignored(relpath: str, is_dir: bool, rules: list[IgnoreRule]) -> bool:
+    ignored = False
+    for rule in rules:
+        if rule.matches(relpath, is_dir):
+            ignored = not rule.negated
+    return ignored
+
+
+def get_exclude_rules(excludes: list[str]) -> list[IgnoreRule]:
+    return [
+        IgnoreRule(
+            base="",
+            regex=gitignore_pattern_to_regex(exclude, anchored="/" in exclude),
+            negated=False,
+            dir_only=False,
+        )
+        for exclude in excludes
+    ]
+
+
+def is_excluded(relpath: str, rules: list[IgnoreRule]) -> bool:
+    """Check whether a file, or any of its parent directories, is excluded."""
+    parts = relpath.split("/")
+    for i in range(1, len(parts)):
+        if is_ignored("/".join(parts[:i]), True, rules):
+            return True
+    return is_ignored(relpath, False, rules)
+
+
+def get_git_toplevel(path: pathlib.Path) -> pathlib.Path | None:
+    proc = subprocess.run(
+        ["git", "rev-parse", "--show-toplevel"],
+        cwd=path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    if proc.returncode != 0:
+        return None
+    return pathlib.Path(proc.stdout.strip()).resolve()
+
+
+def get_git_changed_files(
+    root_path: pathlib.Path,
+    since: str,
+    *,
+    pattern: str,
+    excludes: list[str],
+):
+    """
+    Yield files under `root_path` matching `pattern` that have changed
+    (committed, staged or not) since the git revision `since`, or are untracked.
+    """
+    relpaths = set()
+    for command in (
+        ["git", "diff", "--name-only", "-z", "--relative", "--diff-filter=d", since],
+        ["git", "ls-files", "-z", "--others", "--exclude-standard"],
+    ):
+        # -z, as paths would otherwise be quoted if they contain non-ASCII characters
+        output = subprocess.check_output(command, cwd=root_path, text=True)
+        relpaths.update(relpath for relpath in output.split("\0") if relpath)
+    rules = get_exclude_rules(excludes)
+    for relpath in sorted(relpaths):
+        if fnmatch.fnmatch(relpath.rpartition("/")[2], pattern) and not is_excluded(
+            relpath,
+            rules,
+        ):
+            yield root_path / relpath
+
+
+class ScanIndex:
+    """
+    Remembers the size and mtime of files that needed no (further) changes,
+    so they can be skipped next time unless they have been touched.
+    """
+
+    def __init__(self, path: pathlib.Path, key: str):
+        self.path = path
+        self.key = key
+        self.files = {}
+
+    def load(self):
+        try:
+            data = json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return self
+        # A different alias configuration invalidates everything
+        if data.get("key") == self.key:
+            self.files = data["files"]
+        return self
+
+    def save(self):
+        atomic_write_text(self.path, json.dumps({"key": self.key, "files": self.files}))
+
+    @staticmethod
+    def get_state(file: pathlib.Path):
+        st = file.stat()
+        return [st.st_mtime_ns, st.st_size]
+
+    def is_current(self, file: pathlib.Path) -> bool:
+        return self.files.get(str(file)) == self.get_state(file)
+
+    def record(self, file: pathlib.Path):
+        self.files[str(file)] = self.get_state(file)
+
+
+def atomic_write_text(path: pathlib.Path, text: str):
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+        if path.exists():
+            shutil.copymode(path, temp_name)
+        os.replace(temp_name, path)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+
+
+def walk_files(
+    root_path: pathlib.Path,
+    *,
+    pattern: str,
+    excludes: list[str],
+    use_gitignore: bool,
+):
+    """
+    Yield files under `root_path` whose names match `pattern`,
+    pruning excluded and gitignored directories without descending into them.
+    """
+    rules_by_dir = {"": get_exclude_rules(excludes)}
+    for dirpath, dirnames, filenames in os.walk(root_path):
+        reldir = os.path.relpath(dirpath, root_path).replace(os.sep, "/")
+        reldir = "" if reldir == "." else reldir
+        rules = rules_by_dir.pop(reldir)
+        if use_gitignore and ".gitignore" in filenames:
+            rules = rules + read_gitignore(pathlib.Path(dirpath, ".gitignore"), reldir)
+
+        def relpath_of(name):
+            return f"{reldir}/{name}" if reldir else name
+
+        dirnames[:] = sorted(
+            name for name in dirnames if not is_ignored(relpath_of(name), True, rules)
+        )
+        for name in dirnames:
+            rules_by_dir[relpath_of(name)] = rules
+        for name in sorted(filenames):
+            if fnmatch.fnmatch(name, pattern) and not is_ignored(
+                relpath_of(name),
+                False,
+                rules,
+            ):
+                yield pathlib.Path(dirpath, name)
+
+
+@cache
+def resolve_specifier(directory: pathlib.Path, specifier: str) -> pathlib.Path:
+    # The same (directory, specifier) pairs repeat a lot, and resolving hits the disk
+    return (directory / specifier).resolve()
 
 
 def handle_from(m: re.Match, *, path: pathlib.Path, context: Context):
     mod = m.group(1)
     if ".." not in mod:
         return m.group(0)
-    try:
-        mod_rel_path = (path.parent / mod).resolve().relative_to(context.root_path)
-    except ValueError as ve:
-        print(f"Error in {path}: {ve}")
+    resolved = resolve_specifier(path.parent, mod)
+    at_path = context.get_aliased(resolved)
+    if at_path is None:
+        if context.is_alias_target(resolved):
+            # e.g. `../..` for the `@/*` target itself; nothing to rewrite to
+            return m.group(0)
+        print(
+            f"Error in {path}: {mod} is not within any alias target",
+            file=sys.stderr,
+        )
         return m.group(0)
-    at_path = f"@/{mod_rel_path}"
     if len(at_path) < len(mod) and context.is_acceptable(at_path):
         return f" from '{at_path}';"
     return m.group(0)
 
 
+def make_patch(relpath: str, content: str, new_content: str) -> str:
+    """Make a `git apply`-able patch for a single file."""
+    lines = []
+    for line in difflib.unified_diff(
+        content.splitlines(keepends=True),
+        new_content.splitlines(keepends=True),
+        fromfile=f"a/{relpath}",
+        tofile=f"b/{relpath}",
+    ):
+        lines.append(line)
+        if not line.endswith("\n"):
+            lines.append("\n\\ No newline at end of file\n")
+    return f"diff --git a/{relpath} b/{relpath}\n" + "".join(lines)
+
+
+def process_file(file: pathlib.Path, *, context: Context, write: bool):
+    """
+    Rewrite imports in a file, returning a patch (or None if unchanged).
+    """
+    content = file.read_text()
+    new_content = re.sub(
+        from_comp_re,
+        partial(handle_from, path=file, context=context),
+        content,
+    )
+    if content == new_content:
+        return None
+    if write:
+        atomic_write_text(file, new_content)
+    return make_patch(
+        file.relative_to(context.patch_root or context.root_path).as_posix(),
+        content,
+        new_content,
+    )
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("root")
@@ -44,30 +401,120 @@ def main():
         action="append",
     )
     ap.add_argument("-w", "--write", action="store_true")
+    ap.add_argument(
+        "--tsconfig",
+        type=pathlib.Path,
+        default=None,
+        help="Read path aliases from this tsconfig.json (default: @/ for the root)",
+    )
+    ap.add_argument(
+        "-x",
+        "--exclude",
+        dest="excludes",
+        action="append",
+        default=[],
+        help=f"Gitignore-style pattern to skip (in addition to {', '.join(DEFAULT_EXCLUDES)})",
+    )
+    ap.add_argument(
+        "--no-default-excludes",
+        dest="default_excludes",
+        action="store_false",
+    )
+    ap.add_argument(
+        "--no-gitignore",
+        dest="gitignore",
+        action="store_false",
+        help="Don't skip files ignored by .gitignore files",
+    )
+    ap.add_argument("-j", "--jobs", type=int, default=None)
+    ap.add_argument(
+        "--since",
+        metavar="REV",
+        default=None,
+        help="Only consider files changed since this git revision (and untracked ones)",
+    )
+    ap.add_argument(
+        "--index",
+        type=pathlib.Path,
+        default=None,
+        help="Skip files unchanged (by mtime and size) since they were last found clean",
+    )
+    ap.add_argument(
+        "-o",
+        "--patch-file",
+        type=pathlib.Path,
+        default=None,
+        help="Write the combined patch here instead of stdout",
+    )
     args = ap.parse_args()
+    root_path = pathlib.Path(args.root).resolve()
+    if args.tsconfig:
+        aliases = read_tsconfig_aliases(args.tsconfig)
+        if not aliases:
+            ap.error(f"No wildcard path aliases found in {args.tsconfig}")
+    else:
+        aliases = {str(root_path): "@/"}
     context = Context(
-        root_path=pathlib.Path(args.root).resolve(),
+        root_path=root_path,
         accepted_segments=args.accepted_segments or [],
+        aliases=aliases,
+        # So the patch applies from the top of the repository
+        patch_root=get_git_toplevel(root_path),
     )
-    root_path = pathlib.Path(args.root).resolve()
     write = bool(args.write)
 
-    for file in root_path.rglob("**/*.ts*"):
-        # print(file)
-        content = file.read_text()
-        new_content = re.sub(
-            from_comp_re,
-            partial(handle_from, path=file, context=context),
-            content,
+    excludes = (DEFAULT_EXCLUDES if args.default_excludes else []) + args.excludes
+    if args.since:
+        files = list(
+            get_git_changed_files(
+                root_path,
+                args.since,
+                pattern="*.ts*",
+                excludes=excludes,
+            ),
         )
-        if content != new_content:
-            for line in difflib.unified_diff(
-                content.splitlines(),
-                new_content.splitlines(),
-            ):
-                print(line)
-            if write:
-                file.write_text(new_content)
+    else:
+        files = list(
+            walk_files(
+                root_path,
+                pattern="*.ts*",
+                excludes=excludes,
+                use_gitignore=args.gitignore,
+            ),
+        )
+
+    index = None
+    if args.index:
+        index_key = json.dumps([sorted(aliases.items()), context.accepted_segments])
+        index = ScanIndex(args.index, key=index_key).load()
+        files = [file for file in files if not index.is_current(file)]
+
+    process = partial(process_file, context=context, write=write)
+    if len(files) < SERIAL_THRESHOLD:
+        # Not worth starting up a process pool for
+        patches = list(map(process, files))
+    else:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            patches = list(
+                executor.map(
+                    process,
+                    files,
+                    chunksize=max(1, len(files) // ((args.jobs or os.cpu_count()) * 8)),
+                ),
+            )
+
+    # `map` keeps the order of `files`, so the combined patch is deterministic
+    patch = "".join(p for p in patches if p)
+    if args.patch_file:
+        atomic_write_text(args.patch_file, patch)
+    else:
+        sys.stdout.write(patch)
+
+    if index:
+        for file, file_patch in zip(files, patches):
+            if file_patch is None or write:
+                index.record(file)
+        index.save()
 
 
 if __name__ == "__main__":